@@ -28,6 +28,6 @@ setup(name='NetConnect',
       entry_points={
           'console_scripts': ['netconnect = src.run:main']
       },
-      install_requires=['pyzmq', 'pyserial', 'pyroute2', 'wheel', 'psutil', 'connexion', 'flask-cors', 'swagger_ui_bundle'],
+      install_requires=['pyzmq', 'pyserial', 'pyroute2', 'wheel', 'psutil', 'connexion', 'flask-cors', 'swagger_ui_bundle', 'msgpack'],
       package_data={'': ['*.json', '*.yaml'] + extra_files}
 )
@@ -1,5 +1,12 @@
+import signal
 import logging
-from multiprocessing import Process, Manager
+import threading
+from multiprocessing import Process
+
+from status_store import StatusStore
+
+# time to stop the main loop cooperatively before it is killed (seconds)
+STOP_TIMEOUT = 5
 
 # Allowed connection status:
 # NOT_CONNECTED
@@ -8,15 +15,30 @@ from multiprocessing import Process, Manager
 # INACTIVE
 
 
+class ConnectionStopped(Exception):
+    """Raised in a connection loop running in-process when it is stopped.
+    """
+    pass
+
+
 class Connection(object):
     """docstring for Connection"""
-    def __init__(self, ev_conn):
+    def __init__(self, ev_conn, ev_status=None, status=None, runtime=None):
+        """:param status: Status record in a shared status store, a private
+                          one is created if not given.
+        :param runtime: Runtime running the main loop in-process, the loop
+                        runs in its own process if not given.
+        """
         self._p = None
         self._cfg = None
         self._ev_conn = ev_conn
+        self._runtime = runtime
+        self._stop = threading.Event()
+        self._waiting = None  # event the main loop is waiting for
 
-        mgr = Manager()
-        self._status = mgr.dict()
+        if status is None:
+            status = StatusStore(['status']).record('status', ev_status)
+        self._status = status
         self._status['status'] = 'INACTIVE'
         self._status['error'] = None
         self._status['config'] = None
@@ -31,6 +53,44 @@ class Connection(object):
         """
         raise NotImplementedError('Not implemented')
 
+    def _wait(self, event=None, timeout=None):
+        """Wait in the main loop for the event or timeout. Main loops running
+        in-process must not block anywhere else for long, so they can be
+        stopped.
+
+        :param event: threading.Event, just sleep if not given.
+        :returns: T/F depending if the event is set.
+        :raises ConnectionStopped: When the loop is being stopped.
+        """
+        if event is None:
+            ret = self._stop.wait(timeout)
+        else:
+            self._waiting = event
+            ret = self._stop.is_set() or event.wait(timeout)
+            self._waiting = None
+        if self._stop.is_set():
+            raise ConnectionStopped()
+        return ret
+
+    def _run_process(self, config, status):
+        """Run the main loop in its own process. SIGTERM stops the loop
+        cooperatively in _wait(), so it is never killed in the middle of
+        a status write.
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop_loop())
+        try:
+            self._loop(config, status)
+        except ConnectionStopped:
+            pass
+
+    def _stop_loop(self):
+        """Stop the main loop running in-process.
+        """
+        self._stop.set()
+        waiting = self._waiting
+        if waiting is not None:
+            waiting.set()
+
     def reconnect(self):
         """Force reconnect.
         """
@@ -39,7 +99,13 @@ class Connection(object):
         if self._p is not None and self._p.is_alive():
             log.info('Terminating main loop of %s' % (self.__class__.__name__))
             self._p.terminate()
-            self._p.join()
+            self._p.join(STOP_TIMEOUT)
+            if self._p.is_alive():
+                log.warning('Killing main loop of %s' % (self.__class__.__name__))
+                self._p.kill()
+                self._p.join(STOP_TIMEOUT)
+            if self._p.is_alive():
+                log.error('Main loop of %s does not stop, abandoned' % (self.__class__.__name__))
             self._ev_conn.set()  # update online status
 
         self._p = None
@@ -49,7 +115,11 @@ class Connection(object):
 
         if self._cfg is not None:
             log.info('Set new configuration for %s: %s' % (self.__class__.__name__, str(self._cfg)))
-            self._p = Process(target=self._loop, args=(self._cfg, self._status))
+            self._stop = threading.Event()
+            if self._runtime is None:
+                self._p = Process(target=self._run_process, args=(self._cfg, self._status))
+            else:
+                self._p = self._runtime.task(self._loop, (self._cfg, self._status), self._stop_loop)
             self._p.start()
         else:
             log.info('Disconnecting %s' % (self.__class__.__name__))
@@ -64,7 +134,7 @@ class Connection(object):
     def status(self):
         """Get connection status.
         """
-        return dict(self._status)
+        return self._status.copy()
 
     def info(self):
         """Get connection information.
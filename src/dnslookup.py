@@ -1,5 +1,401 @@
+import os
+import ipaddress
+import random
+import select
 import socket
-from multiprocessing.pool import Pool
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import tools
+
+RESOLV_CONF = '/etc/resolv.conf'
+HOSTS = '/etc/hosts'
+DNS_PORT = 53
+# resolv.conf default of dots in a name to be tried as absolute first
+NDOTS = 1
+# number of cached host names
+CACHE_SIZE = 64
+# upper limit for caching of negative answers (seconds)
+NEGATIVE_TTL = 30
+# retransmit period of an unanswered query (seconds)
+RETRANSMIT = 1
+
+QTYPE_A = 1
+QTYPE_SOA = 6
+QCLASS_IN = 1
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+# truncated message flag, the answer has to be queried over TCP
+FLAG_TC = 0x0200
+
+
+def _encode_name(host):
+    """Encode host name to DNS wire format.
+    """
+    ret = b''
+    for label in host.rstrip('.').encode('idna').split(b'.'):
+        if not label or len(label) > 63:
+            raise ValueError('Invalid host name: %s' % host)
+        ret += bytes([len(label)]) + label
+    return ret + b'\x00'
+
+
+def _skip_name(data, pos):
+    """Skip (possibly compressed) name in DNS message.
+
+    :returns: Position after the name.
+    """
+    while True:
+        length = data[pos]
+        if length & 0xc0 == 0xc0:
+            return pos + 2
+        pos += 1
+        if length == 0:
+            return pos
+        pos += length
+
+
+def _parse_response(data, qid, qname):
+    """Parse DNS response to A query.
+
+    :returns: Touple (rcode, list of (ip, ttl), negative ttl, truncated) or
+              None if the message is not answer to the query.
+    """
+    if len(data) < 12:
+        return None
+    rid, flags, qdcount, ancount, nscount, arcount = struct.unpack('!HHHHHH', data[:12])
+    if rid != qid or not flags & 0x8000 or qdcount != 1:
+        return None
+    if data[12:12 + len(qname)].lower() != qname.lower():
+        return None
+
+    rcode = flags & 0x000f
+    pos = 12 + len(qname) + 4
+    answers = []
+    negative_ttl = NEGATIVE_TTL
+
+    for i in range(ancount + nscount):
+        pos = _skip_name(data, pos)
+        rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', data[pos:pos + 10])
+        pos += 10
+        rdata = data[pos:pos + rdlength]
+        pos += rdlength
+
+        if i < ancount and rtype == QTYPE_A and rclass == QCLASS_IN and rdlength == 4:
+            answers.append((socket.inet_ntoa(rdata), ttl))
+        elif i >= ancount and rtype == QTYPE_SOA and len(rdata) >= 4:
+            # RFC 2308 - negative answer TTL is min(SOA TTL, SOA MINIMUM)
+            minimum = struct.unpack('!I', rdata[-4:])[0]
+            negative_ttl = min(negative_ttl, ttl, minimum)
+
+    return rcode, answers, negative_ttl, bool(flags & FLAG_TC)
+
+
+def _normalize(ip):
+    """Canonical form of IP address, so addresses of replies can be compared
+    to the configured ones.
+
+    :returns: Address string or None if not valid.
+    """
+    try:
+        return str(ipaddress.ip_address(ip))
+    except ValueError:
+        return None
+
+
+class Resolver(object):
+    """Stub resolver of IPv4 addresses. Nameservers from resolv.conf are
+    queried over non-blocking UDP sockets, so no process or thread is spawned
+    per lookup and the timeout is enforced by select(). Truncated answers are
+    queried again over TCP. Positive answers are cached for their TTL,
+    negative ones (NXDOMAIN, no A record) according to SOA minimum but no
+    longer than NEGATIVE_TTL.
+
+    Names are looked up in /etc/hosts first and search domains and ndots of
+    resolv.conf are applied like libc does.
+    """
+
+    def __init__(self, nameservers=None, resolvconf=RESOLV_CONF, cache_size=CACHE_SIZE, hosts=HOSTS):
+        self._static_nameservers = None
+        if nameservers is not None:
+            self._static_nameservers = [i for i in map(_normalize, nameservers) if i is not None]
+        self._resolvconf = resolvconf
+        self._resolvconf_mtime = None
+        self._nameservers = self._static_nameservers or []
+        self._search = []
+        self._ndots = NDOTS
+        self._hosts_path = hosts
+        self._hosts_mtime = None
+        self._hosts = {}  # lower case name -> ip
+        self._cache = OrderedDict()  # host -> (expiration, ip or None)
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+
+    def resolve(self, host, timeout=3, ifname=None):
+        """Resolve IPv4 address of the host.
+
+        :param ifname: Query through the given interface only. Such lookups
+                       are used to probe the interface and bypass the cache
+                       and /etc/hosts.
+        :returns: IP address string or None in case of error or timeout.
+        """
+        try:
+            socket.inet_aton(host)
+            return host
+        except (OSError, TypeError):
+            pass
+
+        if ifname is None:
+            ip = self._get_hosts().get(host.rstrip('.').lower())
+            if ip is not None:
+                return ip
+
+        nameservers = self._get_nameservers()
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(host)
+            if ifname is None and cached is not None and cached[0] > now:
+                self._cache.move_to_end(host)
+                return cached[1]
+
+        if not nameservers:
+            if ifname is not None:
+                return None
+            # nothing to query directly, let libc do the job
+            return self._resolve_libc(host, timeout)
+
+        deadline = now + timeout
+        ip, ttl = None, NEGATIVE_TTL
+        for name in self._search_names(host):
+            try:
+                ret = self._query(name, nameservers, deadline - time.monotonic(), ifname)
+            except Exception:
+                return None
+            if ret is None:
+                return None  # timeout or server failure is not cached
+            ip = ret[0]
+            ttl = ret[1] if ip is not None else min(ttl, ret[1])
+            if ip is not None:
+                break
+        if ifname is not None:
+            return ip
+
+        with self._lock:
+            self._cache[host] = (time.monotonic() + ttl, ip)
+            self._cache.move_to_end(host)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return ip
+
+    def flush(self):
+        with self._lock:
+            self._cache.clear()
+
+    def _search_names(self, host):
+        """Names to be queried for the host in order, see resolv.conf(5).
+        """
+        if host.endswith('.') or not self._search:
+            return [host]
+        names = ['%s.%s' % (host, i) for i in self._search]
+        if host.count('.') >= self._ndots:
+            return [host] + names
+        return names + [host]
+
+    def _get_hosts(self):
+        """IPv4 addresses from /etc/hosts, reloaded whenever the file changes.
+        """
+        try:
+            mtime = os.stat(self._hosts_path).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._hosts_mtime:
+            return self._hosts
+
+        hosts = {}
+        try:
+            with open(self._hosts_path, 'r') as f:
+                for line in f:
+                    row = line.split('#', 1)[0].split()
+                    if len(row) < 2:
+                        continue
+                    try:
+                        if ipaddress.ip_address(row[0]).version != 4:
+                            continue
+                    except ValueError:
+                        continue
+                    for name in row[1:]:
+                        hosts.setdefault(name.lower(), row[0])
+        except OSError:
+            pass
+
+        self._hosts_mtime = mtime
+        self._hosts = hosts
+        return hosts
+
+    def _get_nameservers(self):
+        """Nameservers, search domains and ndots from resolv.conf, reloaded
+        whenever the file changes. Cache is flushed on change since the
+        answers may come from another uplink.
+        """
+        if self._static_nameservers is not None:
+            return self._static_nameservers
+
+        try:
+            mtime = os.stat(self._resolvconf).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._resolvconf_mtime:
+            return self._nameservers
+
+        nameservers = []
+        search = []
+        ndots = NDOTS
+        try:
+            with open(self._resolvconf, 'r') as f:
+                for line in f:
+                    row = line.split()
+                    if len(row) < 2:
+                        continue
+                    if row[0] == 'nameserver':
+                        ns = _normalize(row[1])
+                        if ns is not None:
+                            nameservers.append(ns)
+                    elif row[0] in ('search', 'domain'):
+                        # the last one wins
+                        search = [i.rstrip('.') for i in row[1:]]
+                    elif row[0] == 'options':
+                        for i in row[1:]:
+                            if i.startswith('ndots:') and i[6:].isdigit():
+                                ndots = int(i[6:])
+        except OSError:
+            pass
+
+        self._resolvconf_mtime = mtime
+        self._search = search
+        self._ndots = ndots
+        if nameservers != self._nameservers:
+            self._nameservers = nameservers
+            self.flush()
+        return nameservers
+
+    def _query(self, host, nameservers, timeout, ifname=None):
+        """Query all the nameservers at once and take the first valid answer.
+
+        :returns: Touple (ip or None, ttl) or None on timeout.
+        """
+        qid = random.getrandbits(16)
+        qname = _encode_name(host)
+        query = struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0) + qname + struct.pack('!HH', QTYPE_A, QCLASS_IN)
+        deadline = time.monotonic() + timeout
+
+        socks = {}
+        try:
+            for ns in nameservers:
+                family = socket.AF_INET6 if ':' in ns else socket.AF_INET
+                if family not in socks:
+                    sock = socket.socket(family, socket.SOCK_DGRAM)
+                    sock.setblocking(False)
+                    if ifname is not None:
+                        sock.setsockopt(socket.SOL_SOCKET, tools.SO_BINDTODEVICE, ifname.encode())
+                    socks[family] = sock
+
+            pending = list(nameservers)
+            retransmit_at = 0
+
+            while pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    return None
+                if now >= retransmit_at:
+                    for ns in pending:
+                        family = socket.AF_INET6 if ':' in ns else socket.AF_INET
+                        try:
+                            socks[family].sendto(query, (ns, DNS_PORT))
+                        except OSError:
+                            pass
+                    retransmit_at = now + RETRANSMIT
+
+                wait = min(deadline, retransmit_at) - now
+                readable = select.select(list(socks.values()), [], [], wait)[0]
+                for sock in readable:
+                    try:
+                        data, addr = sock.recvfrom(4096)
+                    except OSError:
+                        continue
+                    ns = _normalize(addr[0])
+                    if ns not in pending:
+                        continue
+                    try:
+                        ret = _parse_response(data, qid, qname)
+                    except (IndexError, struct.error):
+                        ret = None
+                    if ret is None:
+                        continue
+
+                    rcode, answers, negative_ttl, truncated = ret
+                    if truncated and not answers:
+                        ret = self._query_tcp(ns, query, qid, qname, deadline, ifname)
+                        if ret is None:
+                            pending.remove(ns)
+                            continue
+                        rcode, answers, negative_ttl, truncated = ret
+                    if rcode == RCODE_NOERROR and answers:
+                        return answers[0][0], min(i[1] for i in answers)
+                    if rcode in (RCODE_NOERROR, RCODE_NXDOMAIN):
+                        return None, negative_ttl
+                    # SERVFAIL, REFUSED... - wait for other servers
+                    pending.remove(ns)
+            return None
+        finally:
+            for sock in socks.values():
+                sock.close()
+
+    def _query_tcp(self, ns, query, qid, qname, deadline, ifname=None):
+        """Send the query to the nameserver over TCP, eg. after a truncated
+        UDP answer.
+
+        :returns: Parsed response, see _parse_response(), or None on error.
+        """
+        family = socket.AF_INET6 if ':' in ns else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            if ifname is not None:
+                sock.setsockopt(socket.SOL_SOCKET, tools.SO_BINDTODEVICE, ifname.encode())
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+            sock.connect((ns, DNS_PORT))
+            sock.sendall(struct.pack('!H', len(query)) + query)
+            data = b''
+            length = None
+            while length is None or len(data) < length + 2:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    return None
+                data += chunk
+                if length is None and len(data) >= 2:
+                    length = struct.unpack('!H', data[:2])[0]
+            return _parse_response(data[2:length + 2], qid, qname)
+        except (OSError, IndexError, struct.error):
+            return None
+        finally:
+            sock.close()
+
+    def _resolve_libc(self, host, timeout):
+        """Blocking libc lookup run in a shared thread with timeout.
+        """
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=2)
+            self._executor_pid = os.getpid()
+
+        future = self._executor.submit(_resolve, host)
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            return None
 
 
 def _resolve(host):
@@ -10,17 +406,12 @@ def _resolve(host):
     return ret
 
 
-def dnslookup(host, timeout=3):
+_resolver = Resolver()
+
+
+def dnslookup(host, timeout=3, ifname=None):
     """DNS lookup with timeout.
+
+    :param ifname: Query through the given interface only.
     """
-    res = None
-    pool = Pool(processes=1)
-    async_result = pool.apply_async(_resolve, (host, ))
-    try:
-        res = async_result.get(timeout=timeout)
-    except Exception:
-        pool.terminate()
-    else:
-        pool.close()
-    pool.join()
-    return res
+    return _resolver.resolve(host, timeout, ifname)
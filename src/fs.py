@@ -9,11 +9,26 @@ IS_SUB_PORT = re.compile("^\d-\d(\.\d)*$")
 IS_INTERFACE = re.compile("^\d-\d(\.\d)*:\d.\d$")
 
 
-class Container(object):
+class FSLocation(object):
+    """Base of objects with a file system location.
+    """
+    __slots__ = ('name', 'parent', 'fs_path')
+
+    @property
+    def fs_name(self):
+        if self.fs_path.find(os.path.sep) > -1:
+            return self.fs_path[self.fs_path.rfind(os.path.sep) + 1:]
+
+    @property
+    def fs_parent(self):
+        if self.fs_path.find(os.path.sep) > -1:
+            return self.fs_path[:self.fs_path.rfind(os.path.sep)]
+
+
+class Container(FSLocation):
     """Mixin for container objects.
     """
-    name = None
-    parent = None
+    __slots__ = ()
 
     def keys(self):
         return list(self.__iter__())
@@ -37,42 +52,46 @@ class Container(object):
         raise NotImplementedError()
 
 
-class FSLocation(object):
-    """Mixin for objects with a file system location.
-    """
-    fs_path = None
-
-    @property
-    def fs_name(self):
-        if self.fs_path.find(os.path.sep) > -1:
-            return self.fs_path[self.fs_path.rfind(os.path.sep) + 1:]
-
-    @property
-    def fs_parent(self):
-        if self.fs_path.find(os.path.sep) > -1:
-            return self.fs_path[:self.fs_path.rfind(os.path.sep)]
-
-
 class FileAttributes(FSLocation):
     """Mixin for objects handling attributes stored in files. A single file
     represents a single attribute where the file name is the attribute name
     and the file content is the attribute value.
-    """
-    __file_attributes__ = []
 
-    def __getattribute__(self, name):
-        if name in object.__getattribute__(self, '__file_attributes__'):
+    Attributes are read on the first access and cached, use load() to read
+    several of them at once. Access to other attributes is not intercepted.
+    """
+    __slots__ = ('_attrs',)
+    __file_attributes__ = frozenset()
+
+    def __getattr__(self, name):
+        # called only when the normal attribute lookup fails
+        if name not in self.__file_attributes__:
+            raise AttributeError(name)
+        return self.load(name)[0]
+
+    def load(self, *names):
+        """Read the given attributes not read yet.
+
+        :returns: List of attribute values in order of names, None if the
+                  attribute file does not exist.
+        """
+        for name in names:
+            if name in self._attrs:
+                continue
+            if name not in self.__file_attributes__:
+                raise AttributeError(name)
             try:
                 with open(os.path.join(self.fs_path, name), 'r') as file:
-                    return file.read().strip('\n').strip()
+                    self._attrs[name] = file.read().strip('\n').strip()
             except IOError:
-                return None
-        return object.__getattribute__(self, name)
+                self._attrs[name] = None
+        return [self._attrs[name] for name in names]
 
 
 class ReprMixin(object):
     """Mixin for objects inside the USB filesystem tree for debugging.
     """
+    __slots__ = ()
 
     def __repr__(self):
         return '<{0}.{1} [{2}] at {3}>'.format(
@@ -100,9 +119,10 @@ class ReprMixin(object):
             node.printtree(indent + 2)
 
 
-class InterfaceProvider(Container, FSLocation):
+class InterfaceProvider(Container):
     """Mixin for objects providing USB interfaces.
     """
+    __slots__ = ()
 
     @property
     def interfaces(self):
@@ -117,6 +137,7 @@ class InterfaceProvider(Container, FSLocation):
 class InterfaceAggregator(object):
     """Mixin for objects providing USB interface aggregation.
     """
+    __slots__ = ()
 
     def aggregated_interfaces(self, tty=False):
         def aggregate(node, ifaces):
@@ -132,11 +153,14 @@ class InterfaceAggregator(object):
         return ifaces
 
 
-class USB(Container, FSLocation, InterfaceAggregator, ReprMixin):
+class USB(Container, InterfaceAggregator, ReprMixin):
     """Object representing USB filsystem root.
     """
+    __slots__ = ()
 
     def __init__(self, fs_path=USB_FS_ROOT):
+        self.name = None
+        self.parent = None
         self.fs_path = fs_path
 
     def __iter__(self):
@@ -173,7 +197,8 @@ class USB(Container, FSLocation, InterfaceAggregator, ReprMixin):
 class Bus(FileAttributes, InterfaceProvider, ReprMixin):
     """Object representing a USB bus.
     """
-    __file_attributes__ = [
+    __slots__ = ()
+    __file_attributes__ = frozenset([
         'authorized',
         'authorized_default',
         'avoid_reset_quirk',
@@ -204,7 +229,7 @@ class Bus(FileAttributes, InterfaceProvider, ReprMixin):
         'uevent',
         'urbnum',
         'version',
-    ]
+    ])
 
     def __init__(self, name, parent, fs_path):
         if not os.path.isdir(fs_path):
@@ -212,6 +237,7 @@ class Bus(FileAttributes, InterfaceProvider, ReprMixin):
         self.name = name
         self.parent = parent
         self.fs_path = fs_path
+        self._attrs = {}
 
     def __iter__(self):
         for child in os.listdir(self.fs_path):
@@ -231,7 +257,8 @@ class Bus(FileAttributes, InterfaceProvider, ReprMixin):
 class Port(FileAttributes, InterfaceProvider, ReprMixin):
     """Object representing a USB port.
     """
-    __file_attributes__ = [
+    __slots__ = ()
+    __file_attributes__ = frozenset([
         'authorized',
         'avoid_reset_quirk',
         'bcdDevice',
@@ -261,7 +288,7 @@ class Port(FileAttributes, InterfaceProvider, ReprMixin):
         'uevent',
         'urbnum',
         'version',
-    ]
+    ])
 
     def __init__(self, name, parent, fs_path):
         if not os.path.isdir(fs_path):
@@ -269,6 +296,7 @@ class Port(FileAttributes, InterfaceProvider, ReprMixin):
         self.name = name
         self.parent = parent
         self.fs_path = fs_path
+        self._attrs = {}
 
     def __iter__(self):
         for child in os.listdir(self.fs_path):
@@ -288,7 +316,8 @@ class Port(FileAttributes, InterfaceProvider, ReprMixin):
 class Interface(FileAttributes, ReprMixin):
     """Object representing a USB interface.
     """
-    __file_attributes__ = [
+    __slots__ = ()
+    __file_attributes__ = frozenset([
         'bAlternateSetting',
         'bInterfaceClass',
         'bInterfaceNumber',
@@ -299,13 +328,15 @@ class Interface(FileAttributes, ReprMixin):
         'modalias',
         'supports_autosuspend',
         'uevent',
-    ]
+    ])
 
     def __init__(self, parent, fs_path):
         if not os.path.isdir(fs_path):
             raise ValueError('Invalid path given')
+        self.name = None
         self.parent = parent
         self.fs_path = fs_path
+        self._attrs = {}
 
     @property
     def manufacturer(self):
@@ -317,6 +348,11 @@ class Interface(FileAttributes, ReprMixin):
 
     @property
     def tty(self):
+        if 'tty' not in self._attrs:
+            self._attrs['tty'] = self._find_tty()
+        return self._attrs['tty']
+
+    def _find_tty(self):
         def match_tty(path):
             for child in os.listdir(path):
                 if not child.startswith("tty"):
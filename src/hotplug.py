@@ -0,0 +1,256 @@
+import os
+import re
+import logging
+import threading
+
+import tools
+import uevent
+
+# kinds of device events
+NET_ADDED = 'net_added'
+NET_REMOVED = 'net_removed'
+TTY_ADDED = 'tty_added'
+TTY_REMOVED = 'tty_removed'
+
+SYSFS_PATH = '/sys'
+# USB interface directory in device path, eg. '1-1.2:1.0'
+USB_INTERFACE = re.compile(r'^\d+-[\d.]+:\d+\.\d+$')
+
+
+class DeviceEvent(object):
+    """Network interface or tty device appeared or disappeared. Keys not
+    known are None, eg. USB port and usbid of a network interface not
+    connected to USB.
+    """
+    __slots__ = ('kind', 'ifname', 'mac', 'port', 'usbid', 'tty')
+
+    def __init__(self, kind, ifname=None, mac=None, port=None, usbid=None, tty=None):
+        self.kind = kind
+        self.ifname = ifname
+        self.mac = mac
+        self.port = port
+        self.usbid = usbid
+        self.tty = tty
+
+    def __repr__(self):
+        return '<DeviceEvent %s %s>' % (self.kind, ' '.join(
+            '%s=%s' % (i, getattr(self, i)) for i in self.__slots__[1:] if getattr(self, i) is not None))
+
+
+def usb_device(devpath, sys_path=SYSFS_PATH):
+    """Get USB port and usbid of the device given by uevent DEVPATH.
+
+    :returns: Touple (port, usbid), both None if the device is not on USB,
+              usbid is None if the USB device is already gone.
+    """
+    parts = devpath.split('/')
+    for i, part in enumerate(parts):
+        if USB_INTERFACE.match(part):
+            break
+    else:
+        return None, None
+
+    device_path = sys_path + '/'.join(parts[:i])
+    vendor = tools.read_attr(device_path + '/idVendor')
+    product = tools.read_attr(device_path + '/idProduct')
+    usbid = '%s:%s' % (vendor, product) if vendor is not None and product is not None else None
+    return parts[i], usbid
+
+
+class Hotplug(object):
+    """Turns kernel uevents into device events (see DeviceEvent) passed to
+    subscribers as callback(event) from the uevent monitor thread.
+
+    Keys of removed devices can not be read from sysfs any more, so they are
+    remembered since the device was added or since the start.
+    """
+
+    def __init__(self, sys_path=SYSFS_PATH):
+        self.pid = os.getpid()
+        self._sys_path = sys_path
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._known = {}  # (kind, ifname or tty) -> DeviceEvent
+        self._monitor = None
+
+    def open(self):
+        """Subscribe to uevents.
+
+        :raises OSError: When uevents cannot be received.
+        """
+        # the device index subscribes to uevents first, so it is invalidated
+        # before device events are passed on
+        tools.device_index()
+        self._monitor = uevent.uevent_monitor()
+        self._seed()
+        self._monitor.subscribe(self._on_uevent)
+
+    def _seed(self):
+        log = logging.getLogger(__name__)
+        try:
+            devices = tools.netifaces()
+        except Exception as e:
+            log.error('Cannot get list of interfaces: %s' % str(e))
+            return
+
+        for i in devices:
+            if 'ttys' in i:
+                for tty in i['ttys']:
+                    self._known[(TTY_ADDED, tty)] = DeviceEvent(TTY_ADDED, port=i.get('port'),
+                                                                usbid=i.get('usbid'), tty=tty)
+            else:
+                self._known[(NET_ADDED, i['ifname'])] = DeviceEvent(NET_ADDED, i['ifname'], i.get('mac'),
+                                                                    i.get('port'), i.get('usbid'))
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    def _on_uevent(self, event):
+        for i in self._events(event):
+            self._notify(i)
+
+    def _events(self, event):
+        """Device events of the uevent.
+        """
+        subsystem = event.get('SUBSYSTEM')
+        action = event.get('ACTION')
+        devpath = event.get('DEVPATH', '')
+
+        if subsystem == 'net':
+            ifname = event.get('INTERFACE') or os.path.basename(devpath)
+            if action == 'move':
+                # interface renamed
+                yield self._removed(NET_ADDED, NET_REMOVED, os.path.basename(event.get('DEVPATH_OLD', '')))
+                yield self._added(NET_ADDED, ifname, devpath)
+            elif action == 'add':
+                yield self._added(NET_ADDED, ifname, devpath)
+            elif action == 'remove':
+                yield self._removed(NET_ADDED, NET_REMOVED, ifname, devpath)
+
+        elif subsystem == 'tty' and 'DEVNAME' in event:
+            tty = os.path.basename(event['DEVNAME'])
+            if action == 'add':
+                added = self._added(TTY_ADDED, tty, devpath)
+                if added.port is not None:
+                    yield added
+            elif action == 'remove':
+                removed = self._removed(TTY_ADDED, TTY_REMOVED, tty, devpath)
+                if removed.port is not None:
+                    yield removed
+
+    def _added(self, kind, name, devpath):
+        port, usbid = usb_device(devpath, self._sys_path)
+        if kind == NET_ADDED:
+            mac = tools.read_attr('%s%s/address' % (self._sys_path, devpath))
+            ret = DeviceEvent(kind, name, mac, port, usbid)
+        else:
+            ret = DeviceEvent(kind, port=port, usbid=usbid, tty=name)
+        self._known[(kind, name)] = ret
+        return ret
+
+    def _removed(self, added, kind, name, devpath=''):
+        known = self._known.pop((added, name), None)
+        if known is None:
+            known = DeviceEvent(added, port=usb_device(devpath, self._sys_path)[0])
+            if kind == NET_REMOVED:
+                known.ifname = name
+            else:
+                known.tty = name
+        return DeviceEvent(kind, known.ifname, known.mac, known.port, known.usbid, known.tty)
+
+    def _notify(self, event):
+        log = logging.getLogger(__name__)
+        log.debug('Device event: %s' % repr(event))
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                log.error('Device event callback failed: %s' % str(e))
+
+
+_hotplug = None
+_hotplug_lock = threading.Lock()
+
+
+def hotplug():
+    """Get hotplug of the current process. It is created on the first use
+    (also in every forked child process).
+
+    :raises OSError: When uevents cannot be received.
+    """
+    global _hotplug
+
+    with _hotplug_lock:
+        if _hotplug is None or _hotplug.pid != os.getpid():
+            instance = Hotplug()
+            instance.open()
+            _hotplug = instance
+    return _hotplug
+
+
+def matcher(config):
+    """Match events of network interface given by the connection config,
+    see tools.get_iface().
+    """
+    def match(event):
+        if event.kind not in (NET_ADDED, NET_REMOVED):
+            return False
+        if 'mac' in config:
+            return event.mac == config['mac']
+        return (('name' in config and event.ifname == config['name']) or
+                ('usb_port' in config and event.port == config['usb_port']))
+    return match
+
+
+class DeviceWatcher(object):
+    """Watch devices appearing and disappearing using hotplug.
+
+    The event is set on every device event accepted by match(event), so
+    a main loop can sleep in wait() and check its device only when something
+    has changed. If uevents cannot be received the event is never set and
+    the main loop falls back to its period.
+    """
+
+    def __init__(self, match, event=None):
+        """:param event: threading.Event to be set, eg. shared with other
+                         watchers. A new one is created if not given.
+        """
+        log = logging.getLogger(__name__)
+        self.event = event if event is not None else threading.Event()
+        self._match = match
+        try:
+            self._hotplug = hotplug()
+        except OSError as e:
+            log.warning('Device events not available: %s' % str(e))
+            self._hotplug = None
+        else:
+            self._hotplug.subscribe(self._callback)
+
+    def wait(self, timeout=None):
+        """Wait for a device event.
+
+        :returns: T/F depending if there was an event.
+        """
+        ret = self.event.wait(timeout=timeout)
+        self.event.clear()
+        return ret
+
+    def close(self):
+        if self._hotplug is not None:
+            self._hotplug.unsubscribe(self._callback)
+
+    def _callback(self, event):
+        if self._match(event):
+            log = logging.getLogger(__name__)
+            log.info('Device event: %s' % repr(event))
+            self.event.set()
@@ -1,4 +1,210 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import itertools
+import threading
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import zmq
+import zmq.asyncio
+
+try:
+    import msgpack
+except ImportError:  # optional, plain JSON is used without it
+    msgpack = None
+
+ENC_JSON = 'json'
+ENC_MSGPACK = 'msgpack'
+
+
+def encodings():
+    """Message encodings supported by this side, preferred first.
+    """
+    if msgpack is None:
+        return [ENC_JSON]
+    return [ENC_MSGPACK, ENC_JSON]
+
+
+def encode(msg, encoding=ENC_JSON):
+    """Serialize message using the given encoding.
+    """
+    if encoding == ENC_MSGPACK:
+        return msgpack.packb(msg, use_bin_type=True)
+    return json.dumps(msg).encode()
+
+
+def decode(data):
+    """Deserialize message, encoding is recognized by the first byte - JSON
+    messages are objects so they always start with '{'.
+
+    :returns: Touple (message, encoding).
+    """
+    if data[:1] == b'{':
+        return json.loads(data.decode()), ENC_JSON
+    if msgpack is None:
+        raise ValueError('Unsupported message encoding')
+    return msgpack.unpackb(data, raw=False), ENC_MSGPACK
+
+
+class SocketPool(object):
+    """Thread-safe pool of connected REQ sockets of a single endpoint. Sockets
+    are created on demand and kept connected between requests. Sockets are
+    REQ_RELAXED and REQ_CORRELATE so a socket that timed out can be reused
+    right away - a late reply to the previous request is dropped.
+    """
+
+    def __init__(self, context, iface):
+        self.pid = os.getpid()
+        self._context = context
+        self._iface = iface
+        self._free = []
+        self._lock = threading.Lock()
+        self.encoding = None  # negotiated with the server, None until known
+
+    def get(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+
+        req_socket = self._context.socket(zmq.REQ)
+        # https://stackoverflow.com/questions/26915347/zeromq-reset-req-rep-socket-state
+        req_socket.setsockopt(zmq.REQ_RELAXED, 1)
+        req_socket.setsockopt(zmq.REQ_CORRELATE, 1)
+        # do not queue any message (even try/except will not block)
+        req_socket.setsockopt(zmq.LINGER, 0)
+        req_socket.connect(self._iface)
+        return req_socket
+
+    def put(self, req_socket):
+        with self._lock:
+            self._free.append(req_socket)
+
+    def discard(self, req_socket):
+        req_socket.close()
+
+    def close(self):
+        with self._lock:
+            for i in self._free:
+                i.close()
+            self._free = []
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_socket_pool(context, iface):
+    """Get socket pool of the endpoint. Pools are not shared with forked
+    processes.
+    """
+    with _pools_lock:
+        pool = _pools.get(iface)
+        if pool is None or pool.pid != os.getpid() or pool._context is not context:
+            pool = SocketPool(context, iface)
+            _pools[iface] = pool
+    return pool
+
+
+class StatusPublisher(object):
+    """Publishes status values on a PUB socket. A value is sent only if it
+    differs from the last one sent under the same topic.
+    """
+
+    def __init__(self, context, iface):
+        self._socket = context.socket(zmq.PUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.bind(iface)
+        self._sent = {}  # topic -> last sent payload
+
+    def publish(self, topic, value):
+        """Publish the value if changed.
+
+        :returns: T/F depending if the value was sent.
+        """
+        payload = json.dumps(value, sort_keys=True).encode()
+        if self._sent.get(topic) == payload:
+            return False
+        self._sent[topic] = payload
+        self._socket.send_multipart([topic.encode(), payload])
+        return True
+
+    def close(self):
+        self._socket.close()
+
+
+class StatusSubscriber(object):
+    """Receives values published by StatusPublisher and keeps the last value
+    of every topic. Either call recv() periodically or start() a background
+    thread delivering values to a callback.
+    """
+
+    def __init__(self, context, iface, topics=None):
+        self._socket = context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        for topic in (topics or ['']):
+            self._socket.setsockopt(zmq.SUBSCRIBE, topic.encode())
+        self._socket.connect(iface)
+        self._last = {}  # topic -> last received value
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def recv(self, timeout=None):
+        """Receive a single published value.
+
+        :param timeout: Timeout in milliseconds, None waits forever.
+        :returns: Touple (topic, value) or None on timeout.
+        """
+        if not self._socket.poll(timeout):
+            return None
+        topic, payload = self._socket.recv_multipart()
+        topic = topic.decode()
+        value = json.loads(payload.decode())
+        with self._lock:
+            self._last[topic] = value
+        return topic, value
+
+    def last(self, topic=None):
+        """Last value of the topic or dict of all the topics if not given.
+        """
+        with self._lock:
+            if topic is None:
+                return dict(self._last)
+            return self._last.get(topic)
+
+    def seed(self, values):
+        """Fill in topics not received yet, eg. from a status call made after
+        the subscription.
+        """
+        with self._lock:
+            for topic, value in values.items():
+                self._last.setdefault(topic, value)
+
+    def start(self, callback, period=200):
+        """Receive in a background thread and call callback(topic, value) for
+        every value.
+
+        :param period: How often is checked the subscriber was closed (ms).
+        """
+        def run():
+            while not self._closed:
+                ret = self.recv(timeout=period)
+                if ret is not None:
+                    callback(*ret)
+            self._socket.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._closed = True
+        if self._thread is None:
+            self._socket.close()
+        elif self._thread is not threading.current_thread():
+            self._thread.join()
 
 
 class InterfaceGeneral():
@@ -7,6 +213,12 @@ class InterfaceGeneral():
     _child_class = None  # Link to child heritaging class
     _iface = None
     _zmq_context = None
+    _WORKERS = 4  # number of threads executing requests
+    _METHOD_LIMITS = {}  # function name -> max number of concurrent calls
+    _RESERVED = ()  # names of cheap functions having a worker of their own
+    _dispatch = {}  # function name -> implementation, set by loop()
+    _limits = {}  # function name -> semaphore of _METHOD_LIMITS, set by loop()
+    _batch_executor = None
 
     class InterfaceException(Exception):
         """Custom Interface expcetion for handlin interface errors.
@@ -24,82 +236,354 @@ class InterfaceGeneral():
         self._iface = iface
         self._zmq_context = zmq.Context.instance()
 
-    def loop(self):
+    def _dispatch_table(self):
+        """Functions callable over the interface - client methods of the child
+        class that are overridden (implemented) by the running module.
+
+        :returns: Dict function name -> bound method.
+        """
+        table = {}
+        for name in dir(self._child_class):
+            if name.startswith('_'):
+                continue
+            stub = getattr(self._child_class, name)
+            func = getattr(self, name)
+            if not hasattr(stub, '__code__') or not hasattr(func, '__code__'):
+                continue
+            if func.__code__ is not stub.__code__:
+                table[name] = func
+        return table
+
+    def loop(self, on_ready=None):
         """Message receiving blocking function. Supposed to be used in the
         appropriate module only. Parses incoming messages and calls appropriate
         functions from the module.
+
+        Requests are answered in the encoding they came in. A client offering
+        other encodings in 'accept' is told the preferred one supported by
+        both sides, so old JSON only clients keep working.
+
+        Requests are received by a ROUTER socket and executed by a pool of
+        worker threads, so a slow call does not block the others. Number of
+        concurrently running calls of a function can be limited by
+        _METHOD_LIMITS, requests over the limit wait in a queue. One worker is
+        kept for the cheap _RESERVED functions, so they are answered even when
+        slow calls occupy the others. Requests waiting longer than the client
+        timeout are dropped without execution.
+
+        :param on_ready: Optional function called once the interface is bound
+                         and requests are being served.
         """
-        rep_socket = self._zmq_context.socket(zmq.REP)
-        rep_socket.bind(self._iface)
+        dispatch = self._dispatch_table()
+        self._dispatch = dispatch
+        # limits are held by calls of batches too
+        self._limits = {k: threading.Semaphore(v) for k, v in self._METHOD_LIMITS.items()}
+        self._batch_executor = ThreadPoolExecutor(max_workers=self._WORKERS)
+        results_iface = 'inproc://interface-results-%d' % id(self)
+
+        router = self._zmq_context.socket(zmq.ROUTER)
+        router.bind(self._iface)
+        results = self._zmq_context.socket(zmq.PULL)
+        results.bind(results_iface)
+
+        executor = ThreadPoolExecutor(max_workers=self._WORKERS)
+        local = threading.local()
+        running = {}  # function name -> number of running calls
+        queued = {}  # function name -> deque of waiting requests
+        others = [0]  # number of running calls of not reserved functions
+        waiting = deque()  # requests waiting for a not reserved worker
+        shared = self._WORKERS - 1 if self._RESERVED else self._WORKERS
+
+        def work(envelope, msg, encoding):
+            resp = self._call(dispatch, msg)
+            if not hasattr(local, 'push'):
+                local.push = self._zmq_context.socket(zmq.PUSH)
+                local.push.connect(results_iface)
+            reply = b''
+            if resp is not None:
+                if 'id' in msg:
+                    resp['id'] = msg['id']  # correlation of asynchronous clients
+                accept = msg.get('accept') or []
+                for i in encodings():
+                    if i in accept:
+                        resp['encoding'] = i
+                        break
+                reply = encode(resp, encoding)
+            local.push.send_multipart([msg['func'].encode()] + envelope + [reply])
+
+        def schedule(envelope, msg, encoding):
+            func = msg['func']
+            limit = self._METHOD_LIMITS.get(func)
+            if limit is not None and running.get(func, 0) >= limit:
+                queued.setdefault(func, deque()).append((envelope, msg, encoding))
+                return
+            if func not in self._RESERVED:
+                if others[0] >= shared:
+                    waiting.append((envelope, msg, encoding))
+                    return
+                others[0] += 1
+            running[func] = running.get(func, 0) + 1
+            executor.submit(work, envelope, msg, encoding)
+
+        poller = zmq.Poller()
+        poller.register(router, zmq.POLLIN)
+        poller.register(results, zmq.POLLIN)
+        if on_ready is not None:
+            on_ready()
 
         while True:
-            msg = rep_socket.recv_json()
-            resp = {}
-            resp['mod_name'] = self._MOD_NAME
-
-            if getattr(self, msg['func']).__code__ == \
-               getattr(self._child_class, msg['func']).__code__:
-                # Called function has not been implemented
-                # in the child class (probably in ModInterface).
-                resp['status'] = 'error'
-                resp['message'] = 'Function "%s" is not implemented.'\
-                                  % msg['func']
+            for sock, event in poller.poll():
+                if sock is router:
+                    frames = router.recv_multipart()
+                    envelope = frames[:-1]
+                    try:
+                        msg, encoding = decode(frames[-1])
+                        msg['func'] = str(msg['func'])
+                        # clocks of the client and server may differ, the
+                        # deadline is counted from the arrival
+                        msg.pop('deadline', None)
+                        if msg.get('timeout') is not None:
+                            msg['deadline'] = time.monotonic() + float(msg['timeout'])
+                    except Exception:
+                        continue  # malformed request
+                    schedule(envelope, msg, encoding)
+
+                else:
+                    frames = results.recv_multipart()
+                    func = frames[0].decode()
+                    if frames[-1]:
+                        router.send_multipart(frames[1:])
+                    running[func] -= 1
+                    if func not in self._RESERVED:
+                        others[0] -= 1
+                    if queued.get(func):
+                        schedule(*queued[func].popleft())
+                    if waiting and others[0] < shared:
+                        schedule(*waiting.popleft())
+
+    def _batch(self, calls, parallel=()):
+        """Execute several calls of a single batch request. Supposed to be
+        used by batch() implementation of the module.
+
+        :param calls: List of {'func': name, 'params': [..]} dicts.
+        :param parallel: Names of functions safe to run concurrently, the
+                         others are executed one by one in order. Calls
+                         wait for _METHOD_LIMITS like any other call.
+        :returns: List of {'status': .., 'message': ..} in order of calls.
+        """
+        ret = [None] * len(calls)
+        futures = {}
+
+        for i, call in enumerate(calls):
+            msg = {'func': str(call.get('func')), 'params': call.get('params', [])}
+            if msg['func'] == 'batch':
+                ret[i] = {'status': 'error', 'message': 'Nested batch is not allowed.'}
+            elif msg['func'] in parallel:
+                futures[i] = self._batch_executor.submit(self._call, self._dispatch, msg)
             else:
-                # print(msg)
-                # call a function implemented in ModInterface class
-                func = getattr(self, msg['func'])
-                resp['message'] = func(*msg['params'])
-                resp['status'] = 'success'
+                ret[i] = self._call(self._dispatch, msg)
 
-            rep_socket.send_json(resp)
+        for i, future in futures.items():
+            ret[i] = future.result()
+
+        for i in ret:
+            i.pop('mod_name', None)
+        return ret
+
+    def _call(self, dispatch, msg):
+        """Execute a request.
+
+        :returns: Response dict or None if the request expired.
+        """
+        if 'deadline' in msg and msg['deadline'] < time.monotonic():
+            # client is not waiting for the response anymore
+            return None
+
+        resp = {}
+        resp['mod_name'] = self._MOD_NAME
+
+        func = dispatch.get(msg['func'])
+        if func is None:
+            # Called function has not been implemented
+            # in the child class (probably in ModInterface).
+            resp['status'] = 'error'
+            resp['message'] = 'Function "%s" is not implemented.'\
+                              % msg['func']
+            return resp
+
+        try:
+            # call a function implemented in ModInterface class
+            with self._limits.get(msg['func']) or nullcontext():
+                resp['message'] = func(*msg.get('params', []))
+            resp['status'] = 'success'
+        except Exception as e:
+            resp['status'] = 'error'
+            resp['message'] = 'Function "%s" failed: %s' % (msg['func'], str(e))
+        return resp
 
     def _send_cmd(self, func, params, timeout=5000):
-        """Connect to the socket and send a message specified by calling function
-        and its parameters.
+        """Send a message specified by calling function and its parameters
+        using a pooled socket connected to the interface. The first request
+        is sent as JSON offering other supported encodings, the one chosen by
+        the server is used from then on.
 
         :param func: Name of called fucntion.
         :param params: List of parameters for the given function.
         :param timeout: Timeout on send and receive in milliseconds
         :returns: JSON response with the result.
         """
+        pool = get_socket_pool(self._zmq_context, self._iface)
+        req_socket = pool.get()
 
-        context = zmq.Context()
-        req_socket = context.socket(zmq.REQ)
-
-        # https://stackoverflow.com/questions/26915347/zeromq-reset-req-rep-socket-state
         # RCVTIMEO to prevent forever block
         req_socket.setsockopt(zmq.RCVTIMEO, timeout)
         # SNDTIMEO is needed since script may not up up yet
         req_socket.setsockopt(zmq.SNDTIMEO, timeout)
-        req_socket.setsockopt(zmq.REQ_RELAXED, 1)
-        req_socket.setsockopt(zmq.REQ_CORRELATE, 1)
-        # do not queue any message (even try/except will not block)
-        req_socket.setsockopt(zmq.LINGER, 0)
-
-        req_socket.connect(self._iface)
 
         msg = {}
         msg['src_mid'] = self._MOD_NAME
         msg['func'] = func
         msg['params'] = params
+        msg['timeout'] = timeout / 1000.0
+        encoding = pool.encoding
+        if encoding is None:
+            msg['accept'] = encodings()
 
         try:
-            req_socket.send_json(msg)
-            ret = req_socket.recv_json()
-            req_socket.close()
+            req_socket.send(encode(msg, encoding or ENC_JSON))
+            ret = decode(req_socket.recv())[0]
         except zmq.error.Again:
-            req_socket.close()
+            # socket stays usable thanks to REQ_RELAXED, the server may have
+            # been replaced though
+            pool.encoding = None
+            pool.put(req_socket)
             raise
         except Exception:
+            pool.discard(req_socket)
             raise
-        finally:
-            context.destroy()
+        pool.put(req_socket)
+
+        if encoding is None:
+            pool.encoding = ret.pop('encoding', ENC_JSON)
 
         if ret['status'] == 'error':
             raise self.InterfaceException(ret['mod_name'] + ' ' + ret['message'])
 
-        context.destroy()
         return ret
 
     def destroy(self):
+        get_socket_pool(self._zmq_context, self._iface).close()
         self._zmq_context.destroy()
+
+
+class AsyncInterfaceGeneral():
+    """Asyncio counterpart of InterfaceGeneral client side. Requests are sent
+    by a single DEALER socket and replies are matched to requests by message
+    id, so any number of requests can be in flight at once.
+    """
+
+    _iface = None
+    InterfaceException = InterfaceGeneral.InterfaceException
+
+    def __init__(self, iface):
+        """:param iface: A name of the interface as defined for Zero MQ.
+        """
+        self._iface = iface
+        self._zmq_context = zmq.asyncio.Context.instance()
+        self._socket = None
+        self._reader = None
+        self._pending = {}  # message id -> future
+        self._ids = itertools.count()
+        self._encoding = None  # negotiated with the server, None until known
+
+    def _connect(self):
+        if self._socket is not None:
+            return
+        self._socket = self._zmq_context.socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.connect(self._iface)
+        self._reader = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        """Deliver replies to waiting requests. Late replies of requests that
+        timed out or were cancelled are dropped. When the socket fails, the
+        waiting requests fail too and the next request opens a new socket.
+        """
+        try:
+            while True:
+                frames = await self._socket.recv_multipart()
+                try:
+                    ret = decode(frames[-1])[0]
+                    mid = ret.pop('id', None)
+                except Exception:
+                    continue
+                future = self._pending.pop(mid, None)
+                if future is not None and not future.done():
+                    future.set_result(ret)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log = logging.getLogger(__name__)
+            log.error('Interface %s reader failed: %s' % (self._iface, str(e)))
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            self._socket.close()
+            self._socket = None
+            self._reader = None
+
+    async def _send_cmd(self, func, params, timeout=5000):
+        """Send a message specified by calling function and its parameters
+        and wait for the reply.
+
+        :param func: Name of called fucntion.
+        :param params: List of parameters for the given function.
+        :param timeout: Timeout of the call in milliseconds.
+        :returns: Response with the result.
+        :raises asyncio.TimeoutError: When the reply did not come in time.
+        """
+        self._connect()
+        mid = next(self._ids)
+
+        msg = {}
+        msg['src_mid'] = self._MOD_NAME
+        msg['func'] = func
+        msg['params'] = params
+        msg['timeout'] = timeout / 1000.0
+        msg['id'] = mid
+        encoding = self._encoding
+        if encoding is None:
+            msg['accept'] = encodings()
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[mid] = future
+        try:
+            # empty delimiter frame makes the request look like one of REQ
+            await self._socket.send_multipart([b'', encode(msg, encoding or ENC_JSON)])
+            ret = await asyncio.wait_for(future, timeout / 1000.0)
+        finally:
+            self._pending.pop(mid, None)
+
+        if encoding is None:
+            self._encoding = ret.pop('encoding', ENC_JSON)
+
+        if ret['status'] == 'error':
+            raise self.InterfaceException(ret['mod_name'] + ' ' + ret['message'])
+
+        return ret
+
+    def close(self):
+        """Close the socket, requests in flight are cancelled.
+        """
+        if self._socket is None:
+            return
+        self._reader.cancel()
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+        self._socket.close()
+        self._socket = None
+
+    def destroy(self):
+        self.close()
@@ -1,30 +1,100 @@
-from interface_general import InterfaceGeneral
+import time
+import asyncio
+
+import zmq
+
+from interface_general import InterfaceGeneral, AsyncInterfaceGeneral, StatusSubscriber
 
 COMMAND_TIMEOUT = 5000
+# time a single ready request waits for netconnect, the server may wait
+# less (seconds)
+READY_TIMEOUT = 1
+# time for the ready response to arrive (milliseconds)
+READY_MARGIN = 1000
+# wifi scan waits for wpa_supplicant to start (milliseconds)
+SCAN_TIMEOUT = 20000
+STATUS_IFACE = 'ipc:///tmp/netconnect-status.pipe'
+# connections published under 'connection.<name>' topics
+CONNECTIONS = ('lte', 'wifi_client', 'wifi_ap', 'lan')
+ZMQ_IFACE = 'ipc:///tmp/netconnect-interface.pipe'
+
+
+def status_topics(status, topics=None):
+    """Values of published topics taken from status() result.
+
+    :param topics: List of topic prefixes, all topics by default.
+    """
+    values = {'online': status['ncstatus']['online'],
+              'gw': status['gw'],
+              'dns': status['ncstatus']['dns']}
+    for name in CONNECTIONS:
+        conn = dict(status[name])
+        conn.pop('online', None)
+        conn.pop('stats', None)
+        values['connection.' + name] = conn
+    if topics:
+        values = {k: v for k, v in values.items() if any(k.startswith(i) for i in topics)}
+    return values
 
 
 class InterfaceNetconnect(InterfaceGeneral):
     _MOD_NAME = 'netconnect-interface'
 
-    def __init__(self, zmq_iface='ipc:///tmp/netconnect-interface.pipe'):
+    def __init__(self, zmq_iface=ZMQ_IFACE, status_iface=STATUS_IFACE):
         super().__init__(InterfaceNetconnect, zmq_iface)
+        self._status_iface = status_iface
 
     def echo(self, param1, param2, timeout=COMMAND_TIMEOUT):
         ret = self._send_cmd('echo', [param1, param2], timeout=timeout)
         return ret['message']
 
-    def wait_for_ready(self):
+    def ready(self, timeout=READY_TIMEOUT):
+        """Wait until netconnect is ready, see wait_for_ready().
+
+        :param timeout: Time to wait in seconds.
+        :returns: T/F depending if ready.
+        """
+        ret = self._send_cmd('ready', [timeout], timeout=int(timeout * 1000) + READY_MARGIN)
+        return ret['message']
+
+    def wait_for_ready(self, timeout=None):
+        """Block until netconnect is up and ready. The ready request waits in
+        the socket queue until netconnect starts and then until it is ready,
+        it is repeated every READY_TIMEOUT.
+
+        :param timeout: Time to wait in seconds, None waits forever.
+        :returns: T/F depending if ready.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
         while True:
+            wait = READY_TIMEOUT
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
             try:
-                self.echo('a', 'b', timeout=200)
-            except Exception:
-                continue
-            break
+                if self.ready(wait):
+                    return True
+            except zmq.error.Again:
+                pass
 
     def status(self):
         ret = self._send_cmd('status', [], timeout=COMMAND_TIMEOUT)
         return ret['message']
 
+    def status_version(self):
+        """Version of the status, increased by every status change.
+        """
+        ret = self._send_cmd('status_version', [], timeout=COMMAND_TIMEOUT)
+        return ret['message']
+
+    def status_since(self, version):
+        """Status parts changed since the given version, see status(). Always
+        contains the current 'version'.
+        """
+        ret = self._send_cmd('status_since', [version], timeout=COMMAND_TIMEOUT)
+        return ret['message']
+
     def connect(self, config):
         ret = self._send_cmd('connect', [config], timeout=COMMAND_TIMEOUT)
         return ret['message']
@@ -34,7 +104,7 @@ class InterfaceNetconnect(InterfaceGeneral):
         return ret['message']
 
     def wifi_scan(self):
-        ret = self._send_cmd('wifi_scan', [], timeout=COMMAND_TIMEOUT)
+        ret = self._send_cmd('wifi_scan', [], timeout=SCAN_TIMEOUT)
         return ret['message']
 
     def interfaces(self):
@@ -48,3 +118,122 @@ class InterfaceNetconnect(InterfaceGeneral):
     def config(self, config):
         ret = self._send_cmd('config', [config], timeout=COMMAND_TIMEOUT)
         return ret['message']
+
+    def batch(self, calls, timeout=COMMAND_TIMEOUT):
+        """Call several functions in a single round trip.
+
+        :param calls: List of {'func': name, 'params': [..]} dicts.
+        :returns: List of {'status': 'success'/'error', 'message': ..} in order
+                  of calls.
+        """
+        ret = self._send_cmd('batch', [calls], timeout=timeout)
+        return ret['message']
+
+    def subscribe(self, callback=None, topics=None):
+        """Subscribe to status changes published by netconnect. Topics are
+        'connection.<name>' (status of the connection), 'online', 'gw' and
+        'dns'. Last value of every topic is cached by the subscriber and
+        initially filled in by a status call, so no polling is needed.
+
+        :param callback: Optional callback(topic, value) called from
+                         a background thread on every change.
+        :param topics: List of topic prefixes, all topics by default.
+        :returns: StatusSubscriber instance, close() it when not needed.
+        """
+        sub = StatusSubscriber(self._zmq_context, self._status_iface, topics)
+        sub.seed(status_topics(self.status(), topics))
+
+        if callback is not None:
+            sub.start(callback)
+        return sub
+
+
+class AsyncInterfaceNetconnect(AsyncInterfaceGeneral):
+    """Asyncio client of netconnect, see InterfaceNetconnect. Calls can run
+    concurrently and can be cancelled, timeouts raise asyncio.TimeoutError.
+    """
+    _MOD_NAME = 'netconnect-interface'
+
+    def __init__(self, zmq_iface=ZMQ_IFACE, status_iface=STATUS_IFACE):
+        super().__init__(zmq_iface)
+        self._status_iface = status_iface
+
+    async def echo(self, param1, param2, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('echo', [param1, param2], timeout=timeout)
+        return ret['message']
+
+    async def ready(self, timeout=READY_TIMEOUT):
+        ret = await self._send_cmd('ready', [timeout], timeout=int(timeout * 1000) + READY_MARGIN)
+        return ret['message']
+
+    async def wait_for_ready(self, timeout=None):
+        """Wait until netconnect is up and ready, see
+        InterfaceNetconnect.wait_for_ready().
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = READY_TIMEOUT
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+                if wait <= 0:
+                    return False
+            try:
+                if await self.ready(wait):
+                    return True
+            except asyncio.TimeoutError:
+                pass
+
+    async def status(self, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('status', [], timeout=timeout)
+        return ret['message']
+
+    async def status_version(self, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('status_version', [], timeout=timeout)
+        return ret['message']
+
+    async def status_since(self, version, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('status_since', [version], timeout=timeout)
+        return ret['message']
+
+    async def connect(self, config, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('connect', [config], timeout=timeout)
+        return ret['message']
+
+    async def connection_info(self, conn, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('connection_info', [conn], timeout=timeout)
+        return ret['message']
+
+    async def wifi_scan(self, timeout=SCAN_TIMEOUT):
+        ret = await self._send_cmd('wifi_scan', [], timeout=timeout)
+        return ret['message']
+
+    async def interfaces(self, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('interfaces', [], timeout=timeout)
+        return ret['message']
+
+    async def online_check(self, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('online_check', [], timeout=timeout)
+        return ret['message']
+
+    async def config(self, config, timeout=COMMAND_TIMEOUT):
+        ret = await self._send_cmd('config', [config], timeout=timeout)
+        return ret['message']
+
+    async def batch(self, calls, timeout=COMMAND_TIMEOUT):
+        """Call several functions in a single round trip, see
+        InterfaceNetconnect.batch().
+        """
+        ret = await self._send_cmd('batch', [calls], timeout=timeout)
+        return ret['message']
+
+    async def subscribe(self, callback=None, topics=None):
+        """Subscribe to status changes, see InterfaceNetconnect.subscribe().
+        The callback is called in the event loop of the caller.
+        """
+        sub = StatusSubscriber(zmq.Context.instance(), self._status_iface, topics)
+        sub.seed(status_topics(await self.status(), topics))
+
+        if callback is not None:
+            loop = asyncio.get_running_loop()
+            sub.start(lambda topic, value: loop.call_soon_threadsafe(callback, topic, value))
+        return sub
@@ -1,17 +1,20 @@
-import time
 import logging
 
 import tools
+import hotplug
 from connection import Connection
 
+# fallback period of link checks when no link event arrives (seconds)
+LINK_CHECK_PERIOD = 60
+
 # wpa states - DISCONNECTED, SCANNING, COMPLETED, 4WAY_HANDSHAKE, GROUP_HANDSHAKE
 
 class LAN(Connection):
 
-    def __init__(self, ev_conn):
+    def __init__(self, ev_conn, ev_status=None, status=None, runtime=None):
         """Overloaded method: constructor.
         """
-        super().__init__(ev_conn)
+        super().__init__(ev_conn, ev_status, status, runtime)
         self._status['ifname'] = None
 
     def _loop(self, config, status):
@@ -19,55 +22,67 @@ class LAN(Connection):
         """
         log = logging.getLogger(__name__)
         self._status['status'] = 'NOT_CONNECTED'
-        operstate = None
-
-        while True:
-            iface = tools.get_iface(config)
-
-            if iface is not None:
-                try:
-                    self._status['ifname'] = iface.ifname
-                except Exception as e:
-                    log.error('Error: ' + str(e))
-                    time.sleep(1)
-                    continue
-
-                if tools.gen_systemd_networkd(self.__class__.__name__, config['ipv4'], mac=iface.mac,
-                                              metric=1024):
-                    self._status['status'] = 'CONNECTING'
-                    tools.systemd_restart('systemd-networkd')
-                    log.info('Created systemd-networkd configuration for %s (%s)' % (iface.ifname, iface.mac))
-
-                if tools.get_operstate(self._status['ifname']) == 'UP':
-                    self._status['status'] = 'CONNECTED'
-
-            else:
-                self._status['error'] = 'NO_DEVICE_DETECTED'
-                self._status['ifname'] = None
-
-                if tools.remove_networkd_file(self.__class__.__name__):
-                    tools.systemd_restart('systemd-networkd')
-                    log.info('Removed systemd-networkd configuration')
-                    self._ev_conn.set()  # update online status
-
-            ops = tools.get_operstate(self._status['ifname'])
-            if ops == 'UP' and operstate != 'UP':
-                log.info('Link UP')
-                self._ev_conn.set()
-            if ops != 'UP' and operstate == 'UP':
-                log.info('Link DOWN')
-                self._ev_conn.set()
-
-            operstate = ops
-            time.sleep(5)
+        link = tools.LinkWatcher(on_change=self._link_changed)
+        # an interface may appear in the netlink cache before the device index
+        # is invalidated, the device event wakes the loop again
+        devices = hotplug.DeviceWatcher(hotplug.matcher(config), event=link.event)
+
+        try:
+            while True:
+                iface = tools.get_iface(config)
+
+                if iface is not None:
+                    try:
+                        self._status['ifname'] = iface.ifname
+                    except Exception as e:
+                        log.error('Error: ' + str(e))
+                        self._wait(timeout=1)
+                        continue
+
+                    link.watch(iface.ifname)
+
+                    if tools.gen_systemd_networkd(self.__class__.__name__, config['ipv4'], mac=iface.mac,
+                                                  metric=1024):
+                        self._status['status'] = 'CONNECTING'
+                        tools.systemd_restart('systemd-networkd')
+                        log.info('Created systemd-networkd configuration for %s (%s)' % (iface.ifname, iface.mac))
+
+                    if link.up():
+                        self._status['status'] = 'CONNECTED'
+
+                else:
+                    self._status['error'] = 'NO_DEVICE_DETECTED'
+                    self._status['ifname'] = None
+                    link.watch(None)
+
+                    if tools.remove_networkd_file(self.__class__.__name__):
+                        tools.systemd_restart('systemd-networkd')
+                        log.info('Removed systemd-networkd configuration')
+                        self._ev_conn.set()  # update online status
+
+                # sleep until link state changes or an interface appears/disappears
+                self._wait(link.event, timeout=LINK_CHECK_PERIOD)
+                link.event.clear()
+        finally:
+            devices.close()
+            link.close()
+
+    def _link_changed(self, up):
+        """Link state transition reported by the link watcher.
+        """
+        log = logging.getLogger(__name__)
+        log.info('Link UP' if up else 'Link DOWN')
+        self._ev_conn.set()  # update online status
 
     def info(self):
         """Overloaded method: Get connection information.
         """
         ret = {'status': self._status['status']}
-        ret['address'] = tools.get_address(self._status['ifname'])
-        ret['ifstate'] = tools.get_operstate(self._status['ifname'])
-        ret['ifname'] = self._status['ifname']
+        ifname = self._status['ifname']
+        iface = tools.iface_snapshot([ifname]).get(ifname, {})
+        ret['address'] = iface.get('address')
+        ret['ifstate'] = iface.get('operstate')
+        ret['ifname'] = ifname
         return ret
 
     def clean(self):
@@ -2,9 +2,10 @@ import os
 import json
 import logging
 import psutil
-import time
 import shlex
+import threading
 import tools
+import hotplug
 from multiprocessing import Process, Manager, Lock
 from connection import Connection
 from pathlib import Path
@@ -21,6 +22,13 @@ CHATSCRIPT_PATH = '/tmp/gsm-keeper.chat'
 # modem definitions json file
 MODEM_DEFS_PATH = os.path.dirname(os.path.realpath(__file__)) + '/modem_defs.json'
 MODEM_DEFS = json.loads(Path(MODEM_DEFS_PATH).read_text().strip())
+# rules applied before the modem definition - usbid, number of serial ports
+# and ports used, wwan is prefix of the modem network interface used instead
+# of ppp
+MODEM_QUIRKS = [
+    # E3372h with firmware 21.326.62.00.55 that have only two serial ports
+    {'usbid': '12d1:1506', 'ports': 2, 'control': 0, 'data': 1, 'wwan': 'wwx'},
+]
 # How often to check if pppd daemon is running
 PPPD_CHECK = 15
 # connect timeout (seconds)
@@ -57,13 +65,127 @@ CONNECT ''
 """
 
 
+class ModemRule(object):
+    """Serial ports (and network interface) of a modem with given number of
+    serial ports.
+    """
+    __slots__ = ('desc', 'control', 'data', 'ports', 'wwan')
+
+    def __init__(self, desc, control, data, ports=None, wwan=None):
+        """:param ports: Number of serial ports, any if None.
+        :param wwan: Prefix of name of the modem network interface.
+        """
+        self.desc = desc
+        self.control = control
+        self.data = data
+        self.ports = ports
+        self.wwan = wwan
+
+    def match(self, ttys):
+        if self.ports is not None and len(ttys) != self.ports:
+            return False
+        return len(ttys) > max(self.control, self.data)
+
+
+class ModemRegistry(object):
+    """Modem definitions and quirks compiled into rules matching modems by
+    usbid and serial ports. Definitions without serial ports (qmi, mbim, ncm)
+    are not supported.
+
+    Modems resolved are remembered per physical USB device until a hotplug
+    event invalidates the device index, see tools.DeviceIndex.
+    """
+
+    def __init__(self, defs, quirks=MODEM_QUIRKS):
+        self._rules = {}  # usbid -> list of rules, the first matching is used
+        for usbid, modem in defs.items():
+            if 'control' in modem and 'data' in modem:
+                self._rules[usbid] = [ModemRule(modem['desc'], modem['control'], modem['data'])]
+        for quirk in quirks:
+            desc = defs.get(quirk['usbid'], {}).get('desc')
+            rule = ModemRule(desc, quirk['control'], quirk['data'], quirk.get('ports'), quirk.get('wwan'))
+            self._rules.setdefault(quirk['usbid'], []).insert(0, rule)
+
+        self._lock = threading.Lock()
+        self._generation = None
+        self._modems = {}  # USB device (eg. '1-1.2') -> resolved modem or None
+        self._device = None  # USB device of the first modem
+
+    def __contains__(self, usbid):
+        return usbid in self._rules
+
+    def modem(self):
+        """Get the first modem found.
+
+        :returns: Dict {'usbid', 'ports', 'model', 'port_control', 'port_data'}
+                  including 'wwan' interface name of modems without ppp, None
+                  if there is no supported modem.
+        """
+        index = tools.device_index()
+        with self._lock:
+            generation = index.generation()
+            if generation != self._generation or not index.cached():
+                self._resolve_all(index.devices())
+                self._generation = generation
+            modem = self._modems.get(self._device)
+
+        if modem is None:
+            return None
+        return dict(modem, ports=list(modem['ports']))
+
+    def _resolve_all(self, devices):
+        self._modems = {}
+        self._device = None
+        for i in devices:
+            if i['ifname'] != 'ppp':
+                continue
+            device = i['port'].split(':')[0]
+            if self._device is None:
+                self._device = device
+            self._modems[device] = self.resolve(i, devices)
+
+    def resolve(self, rec, devices):
+        """Resolve modem by the rules of its usbid.
+
+        :param rec: Record of the modem as returned by tools.netifaces().
+        :param devices: All records, network interface of the modem is
+                        searched for among them.
+        """
+        ttys = rec['ttys']
+        for rule in self._rules.get(rec['usbid'], []):
+            if rule.match(ttys):
+                break
+        else:
+            return None
+
+        ret = {'usbid': rec['usbid'],
+               'ports': ttys,
+               'model': rule.desc,
+               'port_control': '/dev/' + ttys[rule.control],
+               'port_data': '/dev/' + ttys[rule.data]}
+
+        if rule.wwan is not None:
+            device = rec['port'].split(':')[0]
+            for i in devices:
+                if (i['ifname'] or '').startswith(rule.wwan) and i.get('port', '').split(':')[0] == device:
+                    ret['wwan'] = i['ifname']
+                    break
+            else:
+                return None
+
+        return ret
+
+
+MODEM_REGISTRY = ModemRegistry(MODEM_DEFS)
+
+
 class Lte(Connection):
 
-    def __init__(self, ev_conn):
+    def __init__(self, ev_conn, ev_status=None, status=None, runtime=None):
         """Overloaded method: constructor.
         """
         self._at_modem = ATModem()
-        super().__init__(ev_conn)
+        super().__init__(ev_conn, ev_status, status, runtime)
         self._status['ifname'] = None
 
     def _loop(self, config, status):
@@ -75,121 +197,128 @@ class Lte(Connection):
         pppdconn = None
         error_status = None
 
-        while True:
-            if self._status['status'] != 'CONNECTED':
+        devices = hotplug.DeviceWatcher(lambda event: event.usbid in MODEM_REGISTRY)
 
-                self._status['ifname'] = None
-                modem = None
-                try:
-                    modem = self._get_modem()
-                except Exception:
-                    pass
+        try:
+            while True:
+                if self._status['status'] != 'CONNECTED':
 
-                if modem is not None and self._at_modem.registered(modem['port_control']) is True:
+                    self._status['ifname'] = None
+                    modem = None
+                    try:
+                        modem = self._get_modem()
+                    except Exception:
+                        pass
 
-                    # create neccessary files and connect
-                    lte_cfg = config['lte']
-                    self._status['status'] = 'CONNECTING'
+                    if modem is not None and self._at_modem.registered(modem['port_control']) is True:
 
-                    if 'wwan' in modem:
-                        error = None
-                        connected = False
-                        try:
-                            self._at_modem.ndis_connect(lte_cfg['apn'], modem['port_control'])
-                        except Exception as e:
-                            error = 'Cannot connect: ' + str(e)
+                        # create neccessary files and connect
+                        lte_cfg = config['lte']
+                        self._status['status'] = 'CONNECTING'
 
-                        time.sleep(5)  # wait for connected
-                        if error is None:
+                        if 'wwan' in modem:
+                            error = None
+                            connected = False
                             try:
-                                connected = self._at_modem.ndis_connected(modem['port_control'])
+                                self._at_modem.ndis_connect(lte_cfg['apn'], modem['port_control'])
                             except Exception as e:
-                                error = 'Cannot get connection status: ' + str(e)
-
-                        if connected:
-                            if tools.gen_systemd_networkd(self.__class__.__name__, {'dhcp': True},
-                                                          ifname=modem['wwan']):
-                                os.system('/bin/ip link set dev %s up' % modem['wwan'])
-                                tools.systemd_restart('systemd-networkd')
-                                log.info('Created systemd-networkd configuration for %s' % modem['wwan'])
+                                error = 'Cannot connect: ' + str(e)
+
+                            self._wait(timeout=5)  # wait for connected
+                            if error is None:
+                                try:
+                                    connected = self._at_modem.ndis_connected(modem['port_control'])
+                                except Exception as e:
+                                    error = 'Cannot get connection status: ' + str(e)
+
+                            if connected:
+                                if tools.gen_systemd_networkd(self.__class__.__name__, {'dhcp': True},
+                                                              ifname=modem['wwan']):
+                                    os.system('/bin/ip link set dev %s up' % modem['wwan'])
+                                    tools.systemd_restart('systemd-networkd')
+                                    log.info('Created systemd-networkd configuration for %s' % modem['wwan'])
+
+
+                                log.info('Link layer of LTE connected')
+                                log.info('Network info: %s' % str(self._at_modem.network_info(modem['port_control'])))
+                                log.info('Signal: %s' % str(self._at_modem.signal(modem['port_control'])))
+                                self._status['status'] = 'CONNECTED'
+                                self._status['error'] = None
+                                self._ev_conn.set()  # update online status
+                                self._status['ifname'] = modem['wwan']
+                                #self._status['dns'] = pppdconn.dns()
+
+                            else:
+                                self._status['error'] = 'Cannot connect (NDIS)'
 
+                        else:
+                            # ppp connection
+                            pppd_params = self._pppd_params(lte_cfg['apn'],
+                                                            lte_cfg['number'],
+                                                            lte_cfg['user'],
+                                                            lte_cfg['password'])
 
-                            log.info('Link layer of LTE connected')
-                            log.info('Network info: %s' % str(self._at_modem.network_info(modem['port_control'])))
-                            log.info('Signal: %s' % str(self._at_modem.signal(modem['port_control'])))
-                            self._status['status'] = 'CONNECTED'
-                            self._status['error'] = None
-                            self._ev_conn.set()  # update online status
-                            self._status['ifname'] = modem['wwan']
-                            #self._status['dns'] = pppdconn.dns()
+                            pppd_params = shlex.split(pppd_params)
 
-                        else:
-                            self._status['error'] = 'Cannot connect (NDIS)'
+                            self._terminate_pppd()
+                            self._wait(timeout=1)
+                            try:
+                                pppdconn = PPPConnection(*pppd_params)
+                            except Exception as e:
+                                self._status['error'] = 'Cannot connect: ' + str(e)
+                                if hasattr(e, 'output') and e.output is not None:
+                                    self._status['error'] += ' pppd output: ' + e.output[-500:]
+                            else:
+                                log.info('Link layer of LTE connected')
+                                log.info('Network info: %s' % str(self._at_modem.network_info(modem['port_control'])))
+                                log.info('Signal: %s' % str(self._at_modem.signal(modem['port_control'])))
+                                self._status['status'] = 'CONNECTED'
+                                self._status['error'] = None
+                                self._ev_conn.set()  # update online status
+                                self._status['ifname'] = 'ppp0'
+                                self._status['dns'] = pppdconn.dns()
 
                     else:
-                        # ppp connection
-                        pppd_params = self._pppd_params(lte_cfg['apn'],
-                                                        lte_cfg['number'],
-                                                        lte_cfg['user'],
-                                                        lte_cfg['password'])
+                        self._status['error'] = 'NO_DEVICE_DETECTED'
 
-                        pppd_params = shlex.split(pppd_params)
+                if self._status['status'] == 'CONNECTED':
 
-                        self._terminate_pppd()
-                        time.sleep(1)
+                    if 'wwan' in modem:
+                        try:
+                            if not self._at_modem.ndis_connected(modem['port_control']):
+                                self._status['error'] = 'Connection interrupted'
+                                self._status['status'] = 'NOT_CONNECTED'
+                        except Exception as e:
+                            self._status['error'] = 'Connection interrupted: ' + str(e)
+                            self._status['status'] = 'NOT_CONNECTED'
+                    else:
                         try:
-                            pppdconn = PPPConnection(*pppd_params)
+                            ret = pppdconn.connected()
                         except Exception as e:
-                            self._status['error'] = 'Cannot connect: ' + str(e)
+                            self._status['error'] = 'Connection interrupted: ' + str(e)
                             if hasattr(e, 'output') and e.output is not None:
                                 self._status['error'] += ' pppd output: ' + e.output[-500:]
+                            self._status['status'] = 'NOT_CONNECTED'
                         else:
-                            log.info('Link layer of LTE connected')
-                            log.info('Network info: %s' % str(self._at_modem.network_info(modem['port_control'])))
-                            log.info('Signal: %s' % str(self._at_modem.signal(modem['port_control'])))
-                            self._status['status'] = 'CONNECTED'
                             self._status['error'] = None
-                            self._ev_conn.set()  # update online status
-                            self._status['ifname'] = 'ppp0'
-                            self._status['dns'] = pppdconn.dns()
-
-                else:
-                    self._status['error'] = 'NO_DEVICE_DETECTED'
-
-            if self._status['status'] == 'CONNECTED':
-
-                if 'wwan' in modem:
-                    try:
-                        if not self._at_modem.ndis_connected(modem['port_control']):
-                            self._status['error'] = 'Connection interrupted'
-                            self._status['status'] = 'NOT_CONNECTED'
-                    except Exception as e:
-                        self._status['error'] = 'Connection interrupted: ' + str(e)
-                        self._status['status'] = 'NOT_CONNECTED'
-                else:
-                    try:
-                        ret = pppdconn.connected()
-                    except Exception as e:
-                        self._status['error'] = 'Connection interrupted: ' + str(e)
-                        if hasattr(e, 'output') and e.output is not None:
-                            self._status['error'] += ' pppd output: ' + e.output[-500:]
-                        self._status['status'] = 'NOT_CONNECTED'
-                    else:
-                        self._status['error'] = None
-                        if ret is False:
-                            self._status['error'] = 'Connection interrupted'
-                            self._status['status'] = 'NOT_CONNECTED'
-
-            if error_status != self._status['error']:
-                if self._status['error'] is not None:
-                    log.info('Error: %s' % (self._status['error']))
-                    self._ev_conn.set()  # update online status
-                error_status = self._status['error']
-                if modem is not None:
-                    log.info('Network info: %s' % str(self._at_modem.network_info(modem['port_control'])))
-                    log.info('Signal: %s' % str(self._at_modem.signal(modem['port_control'])))
-
-            time.sleep(10)
+                            if ret is False:
+                                self._status['error'] = 'Connection interrupted'
+                                self._status['status'] = 'NOT_CONNECTED'
+
+                if error_status != self._status['error']:
+                    if self._status['error'] is not None:
+                        log.info('Error: %s' % (self._status['error']))
+                        self._ev_conn.set()  # update online status
+                    error_status = self._status['error']
+                    if modem is not None:
+                        log.info('Network info: %s' % str(self._at_modem.network_info(modem['port_control'])))
+                        log.info('Signal: %s' % str(self._at_modem.signal(modem['port_control'])))
+
+                # sleep until a modem appears or disappears
+                self._wait(devices.event, timeout=10)
+                devices.event.clear()
+        finally:
+            devices.close()
 
     def info(self):
         """Overloaded method: Get connection information.
@@ -208,50 +337,16 @@ class Lte(Connection):
         ret['modem_info'] = self._at_modem.model(modem['port_control'])
         ret['operator_info'] = self._at_modem.operator(modem['port_control'])
         ret['network_info'] = self._at_modem.network_info(modem['port_control'])
-        ret['address'] = tools.get_address('ppp0')
-        ret['ifstate'] = tools.get_operstate('ppp0')
+        iface = tools.iface_snapshot(['ppp0']).get('ppp0', {})
+        ret['address'] = iface.get('address')
+        ret['ifstate'] = iface.get('operstate')
         ret['ifname'] = 'ppp0'
         return ret
 
     def _get_modem(self):
         """Determine right USB modem interface
         """
-        for i in tools.netifaces():
-            if i['ifname'] == 'ppp':
-                break
-        else:
-            return None
-
-        usbid = i['usbid']
-        if usbid not in MODEM_DEFS:
-            return None
-
-        ports = i['ttys']
-        modem = dict(MODEM_DEFS[usbid])
-        if usbid == '12d1:1506' and len(ports) == 2:
-            # special case E3372h with firmware 21.326.62.00.55 that have only two serial ports
-            modem['control'] = 0
-            modem['data'] = 1
-            for i in tools.netifaces():
-                if i['ifname'].startswith('wwx'):
-                    modem['wwan'] = i['ifname']
-                    break
-            else:
-                return None
-
-        elif (len(ports) < modem['control'] + 1 or len(ports) < modem['data'] + 1):
-            return None
-
-        ret = {'usbid': usbid,
-               'ports': ports,
-               'model': modem['desc'],
-               'port_control': '/dev/' + ports[modem['control']],
-               'port_data': '/dev/' + ports[modem['data']]}
-
-        if 'wwan' in modem:
-            ret['wwan'] = modem['wwan']
-
-        return ret
+        return MODEM_REGISTRY.modem()
 
     def _pppd_params(self, apn, number, user, password):
         """Return pppd command string.
@@ -1,18 +1,24 @@
 import os
+import asyncio
 import logging
 import signal
+import selectors
 import tools
 import time
-import ipaddress
-import subprocess
-from multiprocessing import Process, Manager, Event
+import threading
+import zmq
+from collections import deque
+from multiprocessing import Process, Event
 
 from lan import LAN
 from lte import Lte
 from wifi_client import WifiClient
 from wifi_ap import WifiAP
-from interface_netconnect import InterfaceNetconnect
-import dnslookup
+from interface_netconnect import InterfaceNetconnect, STATUS_IFACE
+from interface_general import StatusPublisher
+from status_store import StatusStore
+from runtime import Runtime
+from probe import ProbeEngine, CheckScheduler, PROBE_KINDS, DEF_PROBES
 
 
 CONFIG_NAME = 'netconnect.conf'
@@ -21,9 +27,13 @@ CONFIG_LOCATION = [ROOT_PATH, '/opt/etc/netconnect']
 SYSTEMD_NETWORK_DIR = '/run/systemd/network'
 DEF_TEST_HOST = 'www.google.com'
 CHECK_ONLINE_PERIOD = 1800
-NETWORKCTL = '/bin/networkctl'
 RESOVLCONF = '/run/netconnect/resolv.conf'
+# set to 'asyncio' to run connections and supervisor in a single process
+RUNTIME_ENV = 'NETCONNECT_RUNTIME'
 FALLBACK_DNS = ['8.8.8.8', '8.8.4.4']
+# longest wait of a single ready request, clients repeat the request so it
+# does not occupy an interface worker for long (seconds)
+READY_WAIT = 1
 
 
 def init_logger():
@@ -41,6 +51,16 @@ def init_logger():
 
 class ModInterface(InterfaceNetconnect):
 
+    # calls changing configuration or occupying wifi interface run one at
+    # a time, others are executed concurrently
+    _METHOD_LIMITS = {'connect': 1, 'config': 1, 'wifi_scan': 1, 'ready': 1}
+    # calls answered from the status store, never waiting for slow ones (eg.
+    # connection_info querying the modem)
+    _RESERVED = ('echo', 'status', 'status_version', 'status_since')
+    # read only calls that can run concurrently inside a batch
+    _BATCH_PARALLEL = ('echo', 'status', 'status_version', 'status_since',
+                       'connection_info', 'interfaces')
+
     def __init__(self, nc):
         super(ModInterface, self).__init__()
         self.nc = nc
@@ -53,6 +73,21 @@ class ModInterface(InterfaceNetconnect):
     def status(self):
         return self.nc.status()
 
+    def ready(self, timeout):
+        """Wait until netconnect is ready, READY_WAIT at most.
+        """
+        return self.nc.ready(min(timeout, READY_WAIT))
+
+    def status_version(self):
+        """Version of the status, changes whenever status changes.
+        """
+        return self.nc.status_version()
+
+    def status_since(self, version):
+        """Parts of the status changed since the given version.
+        """
+        return self.nc.status(since=version)
+
     def connect(self, config):
         """Config and start a connection
         """
@@ -83,70 +118,230 @@ class ModInterface(InterfaceNetconnect):
         """
         return self.nc.config(config)
 
+    def batch(self, calls):
+        """Run several calls in one request.
+        """
+        return self._batch(calls, parallel=self._BATCH_PARALLEL)
+
 
 class Netconnect():
 
-    def __init__(self):
+    def __init__(self, runtime=None):
+        """:param runtime: Runtime running connection loops and supervisor
+                           in-process, each of them runs in its own process
+                           if not given.
+        """
         self._config = list()
-        ev_conn = Event()  # link layer connected event
-
-        self._lte = Lte(ev_conn)
-        self._wifi_client = WifiClient(ev_conn)
-        self._wifi_ap = WifiAP(ev_conn)
-        self._lan = LAN(ev_conn)
+        self._probe = None  # online probe engine, created in supervisor process
+        ev_conn = tools.SelectableEvent()  # link layer connected event
+        ev_status = tools.SelectableEvent()  # connection status changed event
+
+        # status of all the connections and netconnect itself shared by
+        # connection loops, supervisor and interface
+        store = StatusStore(['lte', 'wifi_client', 'wifi_ap', 'lan', 'ncstatus', 'phases'])
+        self._store = store
+        # startup phases - seconds since boot
+        self._phases = store.record('phases')
+        self.phase('start')
+        self._ready = Event()  # supervisor finished its first step
+
+        self._lte = Lte(ev_conn, ev_status, store.record('lte', ev_status), runtime)
+        self._wifi_client = WifiClient(ev_conn, ev_status, store.record('wifi_client', ev_status), runtime)
+        self._wifi_ap = WifiAP(ev_conn, ev_status, store.record('wifi_ap', ev_status), runtime)
+        self._lan = LAN(ev_conn, ev_status, store.record('lan', ev_status), runtime)
         self._ev_conn = ev_conn
-
-        mgr = Manager()
-        self._ncstatus = mgr.dict()
-        Process(target=self._loop, args=(ev_conn,)).start()
-
-        self._ncstatus['online'] = False
-        self._ncstatus['last_online_check'] = int(time.time())
-        self._ncstatus['test_host'] = DEF_TEST_HOST
-        self._ncstatus['dns'] = []
+        self._ev_status = ev_status
+
+        self._ncstatus = store.record('ncstatus')
+        self._ncstatus.update({'online': False,
+                               'last_online_check': int(time.time()),
+                               'test_host': DEF_TEST_HOST,
+                               'test_hosts': [DEF_TEST_HOST],
+                               'probes': DEF_PROBES,
+                               'quorum': 1,
+                               'dns': [],
+                               'link_to_online': None,
+                               'uplinks': {},
+                               'gw': {'ifname': None, 'ip': None}})
+        if runtime is None:
+            Process(target=self._loop, args=(ev_conn,)).start()
+        else:
+            runtime.run(self._supervisor_start(ev_conn))
 
     def _loop(self, ev_conn):
-        log = logging.getLogger(__name__)
-        t0 = 0  # 0 means check online immediately
+        """Supervisor loop. Netlink route/link changes, link layer events of
+        the connections and the online check timer are multiplexed by a single
+        selector so the process sleeps until there is something to do.
+        """
+        sel = selectors.DefaultSelector()
+        for fileobj, handler in self._supervisor_init(ev_conn):
+            sel.register(fileobj, selectors.EVENT_READ, handler)
 
         while True:
-            time.sleep(1)
+            self._supervise()
+            self._publish()
+            self._set_ready()
+            for key, mask in sel.select(timeout=self._supervisor_timeout()):
+                key.data()
+
+    async def _supervisor_start(self, ev_conn):
+        """Start supervisor as a task of the runtime event loop. Watched file
+        objects are handled by the loop, blocking supervisor steps run in
+        a worker thread.
+        """
+        loop = asyncio.get_running_loop()
+        wakeup = asyncio.Event()
 
-            self._ncstatus['dns'] = self.set_nameservers()
+        def ready(handler):
+            handler()
+            wakeup.set()
 
-            if tools.get_default_route()['ifname'] is None:
-                # no default route we, cannot be online anyway
-                self._ncstatus['online'] = False
-                continue
+        for fileobj, handler in self._supervisor_init(ev_conn, threaded=True):
+            loop.add_reader(fileobj, ready, handler)
+        self._supervisor = asyncio.ensure_future(self._supervisor_task(wakeup))
 
-            if ev_conn.wait(timeout=10):
-                # link layer changed status event
-                t0 = 0
+    async def _supervisor_task(self, wakeup):
+        """Supervisor loop of the runtime, see _loop().
+        """
+        log = logging.getLogger(__name__)
+        while True:
+            try:
+                await asyncio.to_thread(self._supervise)
+                self._publish()
+            except Exception as e:
+                log.error('Supervisor failed: %s' % str(e))
+            self._set_ready()
+            try:
+                await asyncio.wait_for(wakeup.wait(), self._supervisor_timeout())
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    def _supervisor_init(self, ev_conn, threaded=False):
+        """Initialize supervisor state.
+
+        :param threaded: Use netlink cache updated by its own thread, the
+                         cache socket cannot be read from a running event
+                         loop (pyroute2 runs a loop of its own).
+        :returns: List of (fileobj, handler) touples to be watched for reading.
+        """
+        self._sched = CheckScheduler(CHECK_ONLINE_PERIOD)
+        self._event_at = time.monotonic()  # last link event, to measure time to online
+        self._link_events = deque()  # times of link events not applied yet
+        self._wakeups = 0
+        self._gw = None
+        self._dns = tools.NetworkdDns()
+
+        self._publisher = StatusPublisher(zmq.Context.instance(), STATUS_IFACE)
+
+        def link_event():
             ev_conn.clear()
+            self._link_event()
+
+        # changes are published after every wakeup, see _loop()
+        ret = [(ev_conn, link_event), (self._ev_status, self._ev_status.clear)]
+
+        if threaded:
+            ev_rtnl = tools.SelectableEvent()
+            tools.rtnl_cache().subscribe(lambda event, record, old: ev_rtnl.set())
+            ret.append((ev_rtnl, ev_rtnl.clear))
+        else:
+            rtnl = tools.rtnl_cache(threaded=False)
+            ret.append((rtnl, rtnl.process))
+        return ret
 
-            # here we are connected on link layer with default gateway
-            if t0 == 0:
-                if self.test_online() is False:
-                    self._ncstatus['online'] = False
-                    # testing with shorter interval until we are online
-                    t0 = 0
-                else:
-                    log.info('Online')
-                    t0 = time.monotonic()
-                    self._ncstatus['online'] = True
-
-                self._ncstatus['last_online_check'] = int(time.time())
-
-            elif t0 + CHECK_ONLINE_PERIOD < time.monotonic():
-                if self.test_online() is False:
-                    self._ncstatus['online'] = False
-                    log.info('Offline')
-                    t0 = 0
-                else:
-                    t0 = time.monotonic()
-                    self._ncstatus['online'] = True
-
-                self._ncstatus['last_online_check'] = int(time.time())
+    def _set_ready(self):
+        if not self._ready.is_set():
+            self.phase('supervisor')
+            self._ready.set()
+
+    def ready(self, timeout=None):
+        """Wait until netconnect knows its state - the supervisor finished its
+        first step.
+
+        :returns: T/F depending if ready.
+        """
+        return self._ready.wait(timeout)
+
+    def phase(self, name):
+        """Record time of a startup phase, the first one only.
+        """
+        if name not in self._phases:
+            self._phases[name] = tools.boottime()
+
+    def _supervisor_timeout(self):
+        """Time to the next online check in seconds or None if there is
+        no check planned (no default route).
+        """
+        if self._gw is None or self._gw['ifname'] is None:
+            return None
+        return self._sched.timeout()
+
+    def _link_event(self):
+        """Link layer changed status event, check online state immediately.
+        Handlers of the runtime run in the event loop thread while a step may
+        be running in a worker thread, so the event is only queued and
+        applied by the next supervisor step.
+        """
+        self._link_events.append(time.monotonic())
+
+    def _supervise(self):
+        """Single supervisor step run after every wakeup.
+        """
+        log = logging.getLogger(__name__)
+        # not published, every change of the store is a status change
+        self._wakeups += 1
+        log.debug('Supervisor wakeup %d' % self._wakeups)
+
+        gw = tools.get_default_route()
+        if gw != self._gw:
+            self._gw = gw
+            self._ncstatus['gw'] = gw
+            self._dns.invalidate()
+            self._link_event()
+        while self._link_events:
+            self._event_at = self._link_events.popleft()
+            self._sched.reset()
+        self._ncstatus['dns'] = self.set_nameservers()
+
+        if gw['ifname'] is None:
+            # no default route we, cannot be online anyway
+            self._ncstatus['online'] = False
+            return
+
+        if not self._sched.due():
+            return
+
+        # default uplink receiving traffic is not probed actively, the others
+        # are checked anyway
+        passive = self._ncstatus['online'] is True and self._sched.inbound_traffic(gw['ifname'])
+
+        # here we are connected on link layer with default gateway
+        online = self.test_online(passive)
+        self._sched.checked(online, passive)
+        if online:
+            if self._ncstatus['online'] is False:
+                latency = round(time.monotonic() - self._event_at, 3)
+                self._ncstatus['link_to_online'] = latency
+                self.phase('online')
+                log.info('Online (%s s after link event)' % latency)
+        else:
+            if self._ncstatus['online'] is True:
+                log.info('Offline')
+        if not passive:
+            self._sched.inbound_traffic(gw['ifname'])  # traffic baseline for the next check
+
+        self._ncstatus['online'] = online
+        self._ncstatus['last_online_check'] = int(time.time())
+
+    def _publish(self):
+        """Publish status values, only the changed ones are really sent.
+        """
+        for name, conn in self._connections().items():
+            self._publisher.publish('connection.' + name, conn.status())
+        self._publisher.publish('online', self._ncstatus['online'])
+        self._publisher.publish('gw', self._gw)
+        self._publisher.publish('dns', self._ncstatus['dns'])
 
     def set_nameservers(self):
         """Set nameservers according to current default route. If not possible
@@ -168,30 +363,16 @@ class Netconnect():
                 return ret['dns']
             return FALLBACK_DNS
 
-        try:
-            ret = subprocess.run([NETWORKCTL, 'status', gw['ifname'], '--no-page'], stdout=subprocess.PIPE)
-            ret = ret.stdout.decode().split()
-
-        except Exception as e:
-            # log.error('Cannot get nameservers: ' + str(e))
-            self.write_dns(RESOVLCONF, FALLBACK_DNS)
-            return FALLBACK_DNS
-
+        link = tools.rtnl_cache().link(gw['ifname'])
         dns_list = []
-        try:
-            i_dns = ret.index('DNS:') + 1
-            for ip in ret[i_dns:]:
-
-                try:
-                    ipaddress.ip_address(ip)
-                except Exception:
-                    break
-                dns_list.append(ip)
-        except Exception as e:
+        if link is not None:
+            dns_list = self._dns.get(link['index'])
+
+        if not dns_list:
             self.write_dns(RESOVLCONF, FALLBACK_DNS)
             return FALLBACK_DNS
 
-        self.write_dns(RESOVLCONF, FALLBACK_DNS)
+        self.write_dns(RESOVLCONF, dns_list)
         return dns_list
 
     def write_dns(self, resolvconf, dns_list):
@@ -205,15 +386,40 @@ class Netconnect():
     def online_check(self):
         self._ev_conn.set()
 
-    def status(self):
-        ret = {'lte': self._lte.status(),
-               'wifi_client': self._wifi_client.status(),
-               'wifi_ap': self._wifi_ap.status(),
-               'lan': self._lan.status(),
-               'ncstatus': dict(self._ncstatus),
-               'gw': tools.get_default_route()}
+    def status(self, since=None):
+        """Get status of connections and netconnect itself.
+
+        :param since: Status version known to the caller, only the parts
+                      changed since then are returned if given.
+        :returns: Dict with keys 'lte', 'wifi_client', 'wifi_ap', 'lan',
+                  'ncstatus', 'gw' and 'version' of the status.
+        """
+        version, records = self._store.snapshot()
+        changed = [k for k, v in records.items() if since is None or v[0] > since]
+        if 'ncstatus' in changed:
+            # uplink state is merged into connections
+            changed.extend(i for i in self._uplinks() if i not in changed)
+
+        ret = {'version': version}
+        for name in changed:
+            ret[name] = records[name][1]
+        ncstatus = records['ncstatus'][1]
+        gw = ncstatus.pop('gw', None)
+        if 'ncstatus' in ret:
+            ret['gw'] = gw
+
+        # online state and round trip statistics measured through the
+        # connection interface
+        uplinks = ncstatus.get('uplinks', {})
+        for name in self._uplinks():
+            if name in ret:
+                ret[name]['online'] = uplinks.get(name, {}).get('online', False)
+                ret[name]['stats'] = uplinks.get(name, {}).get('stats')
         return ret
 
+    def status_version(self):
+        return self._store.version()
+
     def connection_info(self, conn):
         if conn == 'lte':
             return self._lte.info()
@@ -239,35 +445,98 @@ class Netconnect():
 
     def config(self, config):
         """Netconnect main configuration. Does nothing in case of same config.
+
+        :param config: Dict with optional keys 'test_host' (single online
+                       check target), 'test_hosts' (list of targets),
+                       'probes' (list of probe kinds, see probe.PROBE_KINDS)
+                       and 'quorum' (number of targets that must pass).
         """
-        self._ncstatus['test_host'] = config.get('test_host')
+        if config.get('test_hosts'):
+            self._ncstatus['test_hosts'] = list(config['test_hosts'])
+            self._ncstatus['test_host'] = config['test_hosts'][0]
+        elif config.get('test_host'):
+            self._ncstatus['test_hosts'] = [config['test_host']]
+            self._ncstatus['test_host'] = config['test_host']
+
+        if config.get('probes'):
+            self._ncstatus['probes'] = [i for i in config['probes'] if i in PROBE_KINDS]
+        if config.get('quorum'):
+            self._ncstatus['quorum'] = int(config['quorum'])
 
     def wifi_scan(self):
         """"Scan wifi networks.
         """
         return self._wifi_client.scan()
 
-    def test_online(self):
-        """"Test if we are online.
+    def test_online(self, passive=False):
+        """"Test if we are online. Every connected uplink is probed through its
+        own interface, all of them concurrently, and per uplink results are
+        stored in ncstatus. Online state is the one of the uplink owning the
+        default route.
+
+        :param passive: Do not probe the default uplink, it is online as it
+                        keeps receiving traffic.
         """
-        test_host = str(self._ncstatus['test_host'])
-        for i in range(3):
-            ip = dnslookup.dnslookup(test_host, i + 1)
-            if ip is not None:
+        log = logging.getLogger(__name__)
+        if self._probe is None:
+            self._probe = ProbeEngine()
+
+        uplinks = {}
+        for name, conn in self._uplinks().items():
+            status = conn.status()
+            if status.get('status') == 'CONNECTED' and status.get('ifname') is not None:
+                uplinks[name] = status['ifname']
+
+        gw = tools.get_default_route()
+        default = None
+        for name, ifname in uplinks.items():
+            if ifname == gw['ifname']:
+                default = name
                 break
         else:
-            # cannot resolve IP
-            return False
-
-        for i in range(2):
-            if tools.ping_test(test_host) or tools.http_test(test_host):
-                return True
+            # default route is not owned by any connection, follow routing
+            uplinks[None] = None
+
+        probed = {k: v for k, v in uplinks.items() if not passive or k != default}
+        ret = {}
+        if probed:
+            ret = self._probe.run_uplinks(probed, list(self._ncstatus['test_hosts']),
+                                          kinds=list(self._ncstatus['probes']),
+                                          quorum=self._ncstatus['quorum'])
+        if passive:
+            log.debug('Default uplink receives traffic, not probed')
+            ret[default] = {'online': True, 'passed': [], 'results': {}, 'elapsed': 0}
+
+        now = int(time.time())
+        status = {}
+        for name in self._uplinks():
+            if name in ret:
+                status[name] = {'ifname': uplinks[name], 'online': ret[name]['online'],
+                                'last_check': now}
+            else:
+                status[name] = {'ifname': None, 'online': False, 'last_check': now}
+            status[name]['stats'] = self._probe.stats(name)
+        self._ncstatus['uplinks'] = status
+
+        if not ret[default]['online']:
+            log.debug('Online check failed: %s' % str(ret[default]['results']))
+        return ret[default]['online']
+
+    def _connections(self):
+        return {'lte': self._lte, 'wifi_client': self._wifi_client,
+                'wifi_ap': self._wifi_ap, 'lan': self._lan}
+
+    def _uplinks(self):
+        """Connections that can be used as an uplink.
+        """
+        return {'lte': self._lte, 'wifi_client': self._wifi_client, 'lan': self._lan}
 
-        return False
 
+def main(notify=True):
+    """Main loop
 
-def main():
-    """Main loop"""
+    :param notify: Notify systemd once netconnect is ready.
+    """
     log = logging.getLogger(__name__)
     log.info('Starting netconnect[%d]' % (os.getpid()))
 
@@ -275,7 +544,12 @@ def main():
     os.makedirs(os.path.dirname(RESOVLCONF), exist_ok=True)
     pid = os.getpid()
 
-    nc = Netconnect()
+    runtime = None
+    if os.environ.get(RUNTIME_ENV) == 'asyncio':
+        log.info('Running connections in a single process')
+        runtime = Runtime()
+
+    nc = Netconnect(runtime)
     m_i = ModInterface(nc)
 
     def sig_handler(signum, frame):
@@ -286,7 +560,17 @@ def main():
     signal.signal(signal.SIGINT, sig_handler)
     signal.signal(signal.SIGTERM, sig_handler)
 
-    m_i.loop()
+    def notify_ready():
+        nc.ready()
+        log.info('Netconnect ready, startup phases: %s' % str(nc.status()['phases']))
+        if notify:
+            tools.sd_notify('READY=1')
+
+    def interface_ready():
+        nc.phase('interface')
+        threading.Thread(target=notify_ready, daemon=True).start()
+
+    m_i.loop(on_ready=interface_ready)
 
 
 if __name__ == "__main__":
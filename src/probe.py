@@ -0,0 +1,306 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import tools
+import dnslookup
+
+# supported probe kinds
+PROBE_KINDS = ('dns', 'ping', 'http')
+DEF_PROBES = ['ping', 'http']
+# global deadline of a single online check (seconds)
+DEF_DEADLINE = 8
+# timeout of a single DNS lookup (seconds)
+DNS_TIMEOUT = 3
+MAX_WORKERS = 12
+# number of ping samples kept per uplink
+STATS_SIZE = 100
+# online check period while online (seconds)
+CHECK_PERIOD = 1800
+# online check period after recent flaps (seconds)
+FLAP_PERIOD = 60
+# state changes within FLAP_WINDOW seconds considered as flapping
+FLAP_COUNT = 2
+FLAP_WINDOW = 900
+# backoff of online checks while offline (seconds)
+BACKOFF_MIN = 5
+BACKOFF_MAX = 300
+# relative jitter of backoff
+BACKOFF_JITTER = 0.2
+# received packets since the last check proving the uplink is still alive
+PASSIVE_RX_PACKETS = 20
+# checks in a row passed by inbound traffic, the next one is active - the
+# traffic may be just broadcasts of the LAN while the upstream is dead
+PASSIVE_MAX_SKIPS = 2
+
+
+def _resolve(target):
+    """Resolve the target using the common (default route) resolver. Probes
+    bound to an interface then test reachability of the resolved address.
+    """
+    return dnslookup.dnslookup(target, DNS_TIMEOUT)
+
+
+def probe_dns(target, ifname=None):
+    """Name resolution probe.
+
+    :returns: Touple (T/F, None).
+    """
+    return dnslookup.dnslookup(target, DNS_TIMEOUT, ifname=ifname) is not None, None
+
+
+def probe_ping(target, ifname=None):
+    """ICMP echo probe of the target.
+
+    :returns: Touple (T/F, list of round trip times).
+    """
+    ip = target if ifname is None else _resolve(target)
+    if ip is None:
+        return False, None
+    rtts = tools.ping_stats(ip, ifname=ifname)
+    return any(i is not None for i in rtts), rtts
+
+
+def probe_http(target, ifname=None):
+    """HTTPS request probe of the target.
+
+    :returns: Touple (T/F, None).
+    """
+    if ifname is None:
+        return tools.http_test(target), None
+    ip = _resolve(target)
+    if ip is None:
+        return False, None
+    return tools.http_test(target, ifname=ifname, ip=ip), None
+
+
+PROBES = {'dns': probe_dns, 'ping': probe_ping, 'http': probe_http}
+
+
+class LinkStats(object):
+    """Ring buffer of ping round trip times of an uplink.
+    """
+
+    def __init__(self, size=STATS_SIZE):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, rtts):
+        """Add samples, None stands for a lost echo request.
+        """
+        with self._lock:
+            self._samples.extend(rtts)
+
+    def summary(self):
+        """Get statistics of samples in the buffer.
+
+        :returns: Dict {'samples', 'min', 'avg', 'p95', 'loss'}, times in
+                  milliseconds, loss in percent.
+        """
+        with self._lock:
+            samples = list(self._samples)
+
+        ret = {'samples': len(samples), 'min': None, 'avg': None, 'p95': None, 'loss': None}
+        if not samples:
+            return ret
+
+        rtts = sorted(i for i in samples if i is not None)
+        ret['loss'] = round(100.0 * (len(samples) - len(rtts)) / len(samples), 1)
+        if rtts:
+            ret['min'] = rtts[0]
+            ret['avg'] = round(sum(rtts) / len(rtts), 2)
+            ret['p95'] = rtts[min(len(rtts) - 1, int(round(0.95 * (len(rtts) - 1))))]
+        return ret
+
+
+class CheckScheduler(object):
+    """Plans online checks. While online the checks run with a long period
+    that is shortened after recent online/offline flaps. While offline the
+    period backs off exponentially with jitter. A link event resets the
+    backoff and plans an immediate check.
+
+    Active probes of the default uplink can be skipped while online when it
+    keeps receiving traffic, see inbound_traffic().
+    """
+
+    def __init__(self, period=CHECK_PERIOD):
+        self.next_check = 0  # monotonic time of the next check
+        self._period = period
+        self._backoff = BACKOFF_MIN
+        self._online = None
+        self._flaps = deque(maxlen=FLAP_COUNT)
+        self._rx = (None, None)  # (ifname, rx packets) at the last check
+        self._forced = True  # active check required
+        self._skips = 0  # checks in a row passed by inbound traffic
+
+    def reset(self):
+        """Check immediately and actively, eg. after a link event.
+        """
+        self.next_check = 0
+        self._backoff = BACKOFF_MIN
+        self._forced = True
+
+    def due(self):
+        return time.monotonic() >= self.next_check
+
+    def timeout(self):
+        """Seconds to the next check.
+        """
+        return max(0, self.next_check - time.monotonic())
+
+    def checked(self, online, passive=False):
+        """Plan the next check according to result of the current one.
+
+        :param passive: The uplink was not probed, see inbound_traffic().
+        """
+        now = time.monotonic()
+        self._forced = False
+        self._skips = self._skips + 1 if passive else 0
+        if self._online is not None and online != self._online:
+            self._flaps.append(now)
+        self._online = online
+
+        if online:
+            self._backoff = BACKOFF_MIN
+            period = self._period
+            if len(self._flaps) == FLAP_COUNT and now - self._flaps[0] < FLAP_WINDOW:
+                period = min(period, FLAP_PERIOD)
+        else:
+            period = self._backoff
+            self._backoff = min(self._backoff * 2, BACKOFF_MAX)
+
+        jitter = random.uniform(-BACKOFF_JITTER, BACKOFF_JITTER) if not online else 0
+        self.next_check = now + period * (1 + jitter)
+
+    def inbound_traffic(self, ifname):
+        """Find out if the interface received traffic since the last call.
+        Only meaningful while online - any traffic proves nothing when the
+        uplink is broken.
+
+        :returns: T/F depending if at least PASSIVE_RX_PACKETS were received.
+                  Always F if an active check was requested by reset() or
+                  after PASSIVE_MAX_SKIPS passive checks in a row.
+        """
+        rx = tools.rx_packets(ifname)
+        last = self._rx
+        self._rx = (ifname, rx)
+        if self._forced or self._skips >= PASSIVE_MAX_SKIPS:
+            return False
+        if rx is None or last[0] != ifname or last[1] is None:
+            return False
+        return rx - last[1] >= PASSIVE_RX_PACKETS
+
+
+class ProbeEngine(object):
+    """Runs probes of several kinds against several targets concurrently.
+    A target passes when any of its probes succeeds. The check is over as soon
+    as quorum of targets passed, all the probes finished or the global
+    deadline expired - probes still running are left to finish in
+    background and their results are dropped.
+
+    Probes can be bound to network interfaces, so several uplinks can be
+    checked at once, each through its own interface. Round trip times of ping
+    probes are collected per uplink even for probes finished after the check
+    is over.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._stats = {}  # uplink name -> LinkStats
+
+    def stats(self, name):
+        """Round trip statistics of the uplink, see LinkStats.summary().
+        """
+        if name not in self._stats:
+            return LinkStats().summary()
+        return self._stats[name].summary()
+
+    def run(self, targets, kinds=None, deadline=DEF_DEADLINE, quorum=1, ifname=None):
+        """Run online check.
+
+        :param targets: List of host names or IP addresses.
+        :param kinds: List of probe kinds (see PROBE_KINDS).
+        :param deadline: Global deadline in seconds.
+        :param quorum: Number of targets that have to pass.
+        :param ifname: Probe through the given interface only, None means
+                       according to the routing table.
+        :returns: Dict {'online': T/F, 'passed': [targets],
+                  'results': {target: {kind: T/F/None}}, 'elapsed': seconds}.
+                  None result means the probe did not finish in time.
+        """
+        return self.run_uplinks({None: ifname}, targets, kinds, deadline, quorum)[None]
+
+    def run_uplinks(self, uplinks, targets, kinds=None, deadline=DEF_DEADLINE, quorum=1):
+        """Run online check of several uplinks concurrently.
+
+        :param uplinks: Dict uplink name -> interface name.
+        :returns: Dict uplink name -> result as returned by run().
+        """
+        log = logging.getLogger(__name__)
+        kinds = [i for i in (kinds or DEF_PROBES) if i in PROBES]
+        quorum = max(1, min(quorum, len(targets)))
+        t0 = time.monotonic()
+
+        ret = {}
+        futures = {}
+        for name, ifname in uplinks.items():
+            ret[name] = {'online': False, 'passed': [], 'results': {}, 'elapsed': None}
+            for target in targets:
+                ret[name]['results'][target] = {}
+                for kind in kinds:
+                    ret[name]['results'][target][kind] = None
+                    future = self._executor.submit(PROBES[kind], target, ifname)
+                    future.add_done_callback(self._collect(name))
+                    futures[future] = (name, target, kind)
+
+        pending = set(futures)
+        while pending:
+            timeout = deadline - (time.monotonic() - t0)
+            if timeout <= 0:
+                break
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, target, kind = futures[future]
+                try:
+                    ok = future.result()[0] is True
+                except Exception as e:
+                    log.error('Probe %s of %s failed: %s' % (kind, target, str(e)))
+                    ok = False
+
+                result = ret[name]
+                result['results'][target][kind] = ok
+                if ok and target not in result['passed']:
+                    result['passed'].append(target)
+                if result['elapsed'] is None and len(result['passed']) >= quorum:
+                    result['online'] = True
+                    result['elapsed'] = round(time.monotonic() - t0, 3)
+
+            # drop probes of uplinks that are already decided
+            pending = set(i for i in pending if not ret[futures[i][0]]['online'])
+
+        for future in pending:
+            future.cancel()  # not started yet, no need to run them
+        for result in ret.values():
+            if result['elapsed'] is None:
+                result['elapsed'] = round(time.monotonic() - t0, 3)
+        return ret
+
+    def _collect(self, name):
+        """Done callback storing round trip times of the uplink.
+        """
+        if name not in self._stats:
+            self._stats[name] = LinkStats()
+        stats = self._stats[name]
+
+        def collect(future):
+            try:
+                rtts = future.result()[1]
+            except Exception:
+                return
+            # empty when fping failed without pinging, that is not a loss
+            if rtts:
+                stats.add(rtts)
+        return collect
@@ -8,6 +8,7 @@ from flask_cors import CORS
 from flask import request
 from netconnect import main as netconnect_app  # noqa
 from interface_netconnect import InterfaceNetconnect  # noqa
+import tools
 
 BIN_PATH = os.path.dirname(os.path.realpath(__file__))
 ROOT_PATH = os.path.dirname(BIN_PATH)
@@ -15,6 +16,9 @@ CONFIG = '/etc/netconnect/config.json'
 SWAGGER_SPECIFICATION = BIN_PATH + '/swagger.yaml'
 LOG_LEVEL = logging.DEBUG
 APIPORT = 8080
+# connection info (signal, operator) is not versioned by netconnect, status
+# ETag expires after this period so it is refreshed anyway (seconds)
+STATUS_INFO_PERIOD = 30
 
 # default application configuration
 defconfig = {
@@ -61,6 +65,14 @@ wifi_ap = {
 }
 
 
+def phase(name):
+    """Record time of a startup phase.
+    """
+    log = logging.getLogger(__name__)
+    store['phases'] = dict(store['phases'], **{name: tools.boottime()})
+    log.info('Startup phase %s at %.3f s since boot' % (name, store['phases'][name]))
+
+
 def init_logger():
     """Logger initialization
     """
@@ -171,16 +183,30 @@ def status():
     i_n = InterfaceNetconnect()
     ret = {}
     try:
-        ret['lan'] = i_n.connection_info('lan')
-        ret['wifi_client'] = i_n.connection_info('wifi_client')
-        ret['lte'] = i_n.connection_info('lte')
-        ret['ncstatus'] = i_n.status()
-        ret['counter'] = store['counter']
+        counter = store['counter']
+        phases = store['phases']
+        # the tag is known before the status is built, so a matching
+        # request is answered right away
+        etag = '%d-%d-%d-%d' % (i_n.status_version(), counter, len(phases),
+                                int(time.time() // STATUS_INFO_PERIOD))
+        if request.if_none_match.contains(etag):
+            return '', 304, {'ETag': '"%s"' % etag}
+
+        resp = i_n.batch([{'func': 'connection_info', 'params': ['lan']},
+                          {'func': 'connection_info', 'params': ['wifi_client']},
+                          {'func': 'connection_info', 'params': ['lte']},
+                          {'func': 'status', 'params': []}])
+        for key, i in zip(['lan', 'wifi_client', 'lte', 'ncstatus'], resp):
+            if i['status'] == 'error':
+                raise i_n.InterfaceException(i['message'])
+            ret[key] = i['message']
+        ret['counter'] = counter
+        ret['phases'] = phases
     except Exception as e:
         log.error('Cannot get status information: ' + str(e))
         return {}, 405
 
-    return ret
+    return ret, 200, {'ETag': '"%s"' % etag}
 
 
 # Webserver stuff
@@ -210,7 +236,10 @@ def webserver():
 # MAIN ########################################################################
 init_logger()
 log = logging.getLogger(__name__)
-Process(target=netconnect_app).start()
+store = Manager().dict()
+store['phases'] = {}
+phase('start')
+Process(target=netconnect_app, kwargs={'notify': False}).start()
 
 config = defconfig
 
@@ -221,18 +250,19 @@ except Exception as e:
     log.warning('Configuration file is not available yet')
 
 log.info(json.dumps(config, indent=4, sort_keys=True))
-store = Manager().dict()
 store['config'] = config
 store['counter'] = config['ap_timeout']
 
 i_n = InterfaceNetconnect()
 i_n.wait_for_ready()
+phase('netconnect_ready')
+tools.sd_notify('READY=1')
 ncfg = get_netconnect_config(config)
-# scan for wifi network
+# scan for wifi network, the scan waits for wpa_supplicant to start
 i_n.connect({'wifi_client': {'name': 'wlan0', 'wifi_client': {'ssid': 'scan'}, 'ipv4': {'dhcp': True}},
              'wifi_ap': None})
-time.sleep(1)
 store['scan_result'] = i_n.wifi_scan()
+phase('wifi_scan')
 # set wifi access point
 ncfg = get_netconnect_config(config)
 if config.get('ap_key', None) is not None:
@@ -241,9 +271,10 @@ if config.get('ap_key', None) is not None:
 ncfg['wifi_ap'] = wifi_ap
 ncfg['wifi_client'] = None
 i_n.connect(ncfg)
+phase('wifi_ap')
 # start webserver
-time.sleep(5)
 Process(target=webserver).start()
+phase('webserver')
 
 while True:
     if store['counter'] > 1:
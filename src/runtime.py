@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from connection import ConnectionStopped
+
+# threads running blocking code of connection loops and supervisor steps
+RUNTIME_WORKERS = 8
+
+
+class Runtime(object):
+    """Event loop running connection loops and the supervisor inside the
+    netconnect process instead of a process per each of them. The loop runs
+    in a background thread, so the interface loop keeps the main thread.
+    """
+
+    def __init__(self, workers=RUNTIME_WORKERS):
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=workers,
+                                                          thread_name_prefix='runtime'))
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        """Run coroutine in the event loop and wait for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def task(self, target, args=(), stop=None):
+        """Create task running the given loop function, see LoopTask.
+        """
+        return LoopTask(self, target, args, stop)
+
+
+class LoopTask(object):
+    """Connection loop run as a task of the runtime. Blocking code of the loop
+    runs in a worker thread of the event loop and is stopped cooperatively by
+    the stop callback, see Connection._wait(). Provides the subset of Process
+    interface used by Connection.
+    """
+
+    def __init__(self, runtime, target, args=(), stop=None):
+        self._runtime = runtime
+        self._target = target
+        self._args = args
+        self._stop = stop
+        self._future = None
+
+    def start(self):
+        self._future = asyncio.run_coroutine_threadsafe(self._run(), self._runtime.loop)
+
+    async def _run(self):
+        log = logging.getLogger(__name__)
+        try:
+            await asyncio.to_thread(self._target, *self._args)
+        except ConnectionStopped:
+            pass
+        except Exception as e:
+            log.error('Loop %s failed: %s' % (self._target.__qualname__, str(e)))
+
+    def is_alive(self):
+        return self._future is not None and not self._future.done()
+
+    def terminate(self):
+        if self._stop is not None:
+            self._stop()
+
+    def kill(self):
+        """Threads can not be killed, the loop ends at its next wait. A loop
+        blocked elsewhere (eg. in a subprocess) keeps its worker thread until
+        the call returns.
+        """
+        log = logging.getLogger(__name__)
+        log.warning('Loop %s cannot be killed, left to end at its next wait' % self._target.__qualname__)
+        self.terminate()
+
+    def join(self, timeout=None):
+        """Wait for the loop to end, check is_alive() after a timeout.
+        """
+        log = logging.getLogger(__name__)
+        try:
+            self._future.result(timeout)
+        except TimeoutError:
+            pass
+        except Exception as e:
+            log.error('Loop %s ended by: %s' % (self._target.__qualname__, repr(e)))
@@ -0,0 +1,240 @@
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+from multiprocessing import Lock
+
+import psutil
+
+# maximal size of a single JSON encoded record (bytes)
+RECORD_SIZE = 8192
+# record header - sequence number, payload length and version of the record
+HEADER = struct.Struct('<QIQ')
+HEADER_SIZE = 24
+# pid of the writer holding the lock, at the start of the store
+OWNER = struct.Struct('<Q')
+# writes take microseconds, holder of the lock held longer is checked to be
+# alive (seconds)
+LOCK_TIMEOUT = 1
+# reads of a record being written that long fail instead of spinning forever
+READ_TIMEOUT = 1
+# busy retries of a read before backing off with sleeps
+READ_SPINS = 100
+
+
+class StatusStoreError(Exception):
+    """Record can not be read, eg. its writer was killed in the middle of
+    a write and no other write recovered it yet.
+    """
+    pass
+
+
+class StatusStore(object):
+    """Status records shared by all netconnect processes. The store is
+    a single anonymous shared memory mapping, so it has to be created before
+    the processes are forked and it is released with the last of them.
+
+    Every record is a JSON encoded dict protected by a seqlock: writers
+    serialize on a lock and make the sequence number odd while writing,
+    readers take no lock and just retry when the sequence number was odd or
+    changed during the read.
+
+    The store has a version increased by every real change. Each record keeps
+    the version of its last change, so changes since a known version can be
+    told. The store version is set only after the record is written, so
+    a snapshot never claims a version whose change it does not contain.
+
+    Writers are supposed to be stopped cooperatively. A writer killed anyway
+    in the middle of a write is recovered from - the lock it left held is
+    taken over once its pid recorded in the store is found dead, and the next
+    write of the record fixes its odd sequence number.
+    """
+
+    def __init__(self, names, record_size=RECORD_SIZE):
+        """:param names: List of record names.
+        """
+        self._record_size = record_size
+        # lock owner and the store header (version) are followed by records
+        self._version = OWNER.size
+        self._buf = mmap.mmap(-1, self._version + HEADER_SIZE + len(names) * record_size)
+        self._lock = Lock()
+        self._takeover_lock = Lock()
+        self._records = {}
+        for i, name in enumerate(names):
+            self._records[name] = self._version + HEADER_SIZE + i * record_size
+            self._write(self._records[name], 0, b'{}')
+
+    def size(self):
+        """Size of the shared memory in bytes.
+        """
+        return len(self._buf)
+
+    def record(self, name, ev_status=None):
+        """Get dict like access to the record, see StatusRecord.
+        """
+        return StatusRecord(self, name, ev_status)
+
+    def version(self):
+        """Current version of the store.
+        """
+        return self._read(self._version)[0]
+
+    def read(self, name):
+        """Lock-free read of the record.
+
+        :returns: Touple (version of the record, JSON encoded record).
+        """
+        return self._read(self._records[name])
+
+    def snapshot(self):
+        """Consistent snapshot of all the records.
+
+        :returns: Touple (version, {name: (version of the record, record dict)}).
+        """
+        while True:
+            version = self.version()
+            ret = {}
+            for name, offset in self._records.items():
+                record_version, payload = self._read(offset)
+                ret[name] = (record_version, payload)
+            if self.version() == version:
+                break
+        return version, {k: (v[0], json.loads(v[1].decode())) for k, v in ret.items()}
+
+    def update(self, name, values):
+        """Update keys of the record.
+
+        :returns: T/F depending if any value changed. F also if the record
+                  would not fit into RECORD_SIZE, the record is left as is.
+        """
+        log = logging.getLogger(__name__)
+        offset = self._records[name]
+        self._acquire()
+        try:
+            data = json.loads(self._read(offset, recover=True)[1].decode() or '{}')
+            if all(k in data and data[k] == v for k, v in values.items()):
+                return False
+            data.update(values)
+            payload = json.dumps(data).encode()
+            if len(payload) > self._record_size - HEADER_SIZE:
+                log.error('Status record %s too large: %d B' % (name, len(payload)))
+                return False
+            version = self.version() + 1
+            self._write(offset, version, payload)
+            self._write(self._version, version, b'')
+        finally:
+            OWNER.pack_into(self._buf, 0, 0)
+            self._lock.release()
+        return True
+
+    def _acquire(self):
+        """Acquire the lock, or take it over from a writer that died holding
+        it. The lock is released by whoever holds it then.
+        """
+        log = logging.getLogger(__name__)
+        while not self._lock.acquire(timeout=LOCK_TIMEOUT):
+            owner = OWNER.unpack_from(self._buf, 0)[0]
+            if owner == 0 or _alive(owner):
+                log.warning('Status store lock held by %d for too long' % owner)
+                continue
+            # only one of the waiters takes the lock over
+            with self._takeover_lock:
+                if OWNER.unpack_from(self._buf, 0)[0] == owner:
+                    log.warning('Status store lock left by dead process %d, taking it over' % owner)
+                    OWNER.pack_into(self._buf, 0, os.getpid())
+                    return
+        OWNER.pack_into(self._buf, 0, os.getpid())
+
+    def _read(self, offset, recover=False):
+        """Lock-free read of the record.
+
+        :param recover: Return whatever is in the record if it is being
+                        written for too long, for writers holding the lock
+                        (so there is no write in progress).
+        :raises StatusStoreError: When the record is being written for too
+                                  long.
+        """
+        limit = self._record_size - HEADER_SIZE
+        retries = 0
+        deadline = None
+        while True:
+            seq, length, version = HEADER.unpack_from(self._buf, offset)
+            start = offset + HEADER_SIZE
+            if not seq & 1 or recover:
+                payload = self._buf[start:start + min(length, limit)]
+                if recover or HEADER.unpack_from(self._buf, offset)[0] == seq:
+                    return version, payload
+
+            # write in progress
+            retries += 1
+            if retries > READ_SPINS:
+                if deadline is None:
+                    deadline = time.monotonic() + READ_TIMEOUT
+                elif time.monotonic() > deadline:
+                    raise StatusStoreError('Status record at %d is being written for too long' % offset)
+                time.sleep(0.001)
+
+    def _write(self, offset, version, payload):
+        """Write the record, supposed to be called with the lock held.
+        """
+        if len(payload) > self._record_size - HEADER_SIZE:
+            raise ValueError('Status record too large: %d B' % len(payload))
+        # odd sequence number left by a killed writer is reused
+        seq = HEADER.unpack_from(self._buf, offset)[0] | 1
+        HEADER.pack_into(self._buf, offset, seq, 0, version)
+        start = offset + HEADER_SIZE
+        self._buf[start:start + len(payload)] = payload
+        HEADER.pack_into(self._buf, offset, seq + 1, len(payload), version)
+
+
+def _alive(pid):
+    """Find out if the process exists and is not a zombie.
+    """
+    try:
+        return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
+
+
+class StatusRecord(object):
+    """Dict like access to a status record shared among processes. Values
+    are returned as copies, so they have to be set again to be changed. Sets
+    the given event whenever a value really changes so changes can be
+    published.
+    """
+
+    def __init__(self, store, name, ev_status=None):
+        self._store = store
+        self._name = name
+        self._ev_status = ev_status
+
+    def __getitem__(self, key):
+        return self.copy()[key]
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def __contains__(self, key):
+        return key in self.copy()
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def get(self, key, default=None):
+        return self.copy().get(key, default)
+
+    def keys(self):
+        return self.copy().keys()
+
+    def copy(self):
+        """Plain dict copy of the record.
+        """
+        return json.loads(self._store.read(self._name)[1].decode())
+
+    def update(self, values):
+        """Set several values at once.
+        """
+        if self._store.update(self._name, values) and self._ev_status is not None:
+            self._ev_status.set()
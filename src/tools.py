@@ -1,15 +1,37 @@
 import os
-import glob
+import ctypes
+import ipaddress
+import logging
+import select
+import socket
+import threading
+import time
 import http.client as httplib
 import shlex
-from fs import USB
-from pathlib import Path
+from fs import USB_FS_ROOT
 from subprocess import Popen, PIPE
 from pyroute2 import IPRoute
+from pyroute2.netlink.rtnl import RTMGRP_LINK, RTMGRP_IPV4_IFADDR, RTMGRP_IPV4_ROUTE
 
+import uevent
 from messenger import Messenger
 
 FPING_PATH = '/usr/bin/fping'
+# rtnetlink multicast groups the route/link cache listens to
+RTNL_GROUPS = RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE
+RT_TABLE_MAIN = 254
+# delays between retries of a background loop step failing repeatedly [s]
+RETRY_MIN = 0.1
+RETRY_MAX = 30
+# network interfaces in sysfs
+SYS_NET_PATH = '/sys/class/net'
+# systemd-networkd runtime state directory
+NETIF_PATH = '/run/systemd/netif'
+# inotify(7) events of a file created in a watched directory
+IN_CREATE = 0x100
+IN_MOVED_TO = 0x80
+# not exported by socket module of older python versions
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 25)
 
 
 def touples2dict(touples):
@@ -22,8 +44,439 @@ def touples2dict(touples):
     return ret
 
 
+def run_forever(step, name):
+    """Call step() over and over, eg. reading a socket in a background
+    thread. A failed step (raised or returned F) is retried with exponential
+    backoff, so an error repeating on every call does not spin the CPU.
+
+    :param name: Name of the loop used in logs.
+    """
+    log = logging.getLogger(__name__)
+    delay = RETRY_MIN
+    try:
+        while True:
+            try:
+                ok = step() is not False
+            except Exception as e:
+                log.error('%s failed: %s' % (name, str(e)))
+                ok = False
+            if ok:
+                delay = RETRY_MIN
+                continue
+            time.sleep(delay)
+            delay = min(delay * 2, RETRY_MAX)
+    finally:
+        log.error('%s stopped' % name)
+
+
+class SelectableEvent(object):
+    """Event shared by forked processes that can be waited for by select()
+    together with sockets. Setting the event writes a byte to a pipe, clearing
+    the event drains the pipe.
+    """
+
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+
+    def fileno(self):
+        return self._rfd
+
+    def set(self):
+        try:
+            os.write(self._wfd, b'x')
+        except BlockingIOError:
+            pass  # pipe is full, the event is set anyway
+
+    def clear(self):
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def is_set(self):
+        return self.wait(timeout=0)
+
+    def wait(self, timeout=None):
+        """Wait until the event is set.
+
+        :returns: T/F depending if the event is set.
+        """
+        return bool(select.select([self._rfd], [], [], timeout)[0])
+
+
+class FileWatcher(object):
+    """Watch a directory for files being created by inotify(7), eg. to wait
+    for a control socket of a daemon being started without polling.
+    """
+
+    def __init__(self, path):
+        """:raises OSError: When the directory cannot be watched.
+        """
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if libc.inotify_add_watch(fd, os.fsencode(path), IN_CREATE | IN_MOVED_TO) < 0:
+            err = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(err, os.strerror(err), path)
+        self._fd = fd
+
+    def fileno(self):
+        return self._fd
+
+    def wait(self, timeout=None):
+        """Wait until a file is created in the directory.
+
+        :returns: T/F depending if a file was created.
+        """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return False
+        try:
+            while os.read(self._fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class RtnlCache(object):
+    """Link, IPv4 address and default route cache kept up to date by rtnetlink
+    multicast messages. The tables are dumped once when the cache is opened and
+    then updated incrementally, so lookups do not touch netlink at all.
+
+    Subscribers registered by subscribe() are called as
+    callback(event, record, old) for every applied change, where event is the
+    rtnetlink message type (eg. 'RTM_NEWLINK') or 'RESYNC' after a full
+    reload of the tables.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._lock = threading.RLock()
+        self._links = {}  # index -> link record
+        self._addrs = {}  # index -> list of address records
+        self._routes = {}  # (oif, priority) -> default route record
+        self._callbacks = []
+        self._ipr = None
+        self._thread = None
+
+    def open(self):
+        """Subscribe to multicast groups and load initial tables. Socket is
+        bound before the dump so no change can be missed in between.
+        """
+        self._ipr = IPRoute()
+        self._ipr.bind(groups=RTNL_GROUPS)
+        self._resync()
+
+    def start(self):
+        """Open the cache and process messages in a background thread. The
+        socket is opened by the thread itself, some pyroute2 versions do not
+        allow to read a socket from other thread than the one created it.
+        """
+        opened = threading.Event()
+        error = []
+        self._thread = threading.Thread(target=self._run, args=(opened, error), daemon=True)
+        self._thread.start()
+        opened.wait()
+        if error:
+            raise error[0]
+
+    def fileno(self):
+        return self._ipr.fileno()
+
+    def _run(self, opened, error):
+        try:
+            self.open()
+        except Exception as e:
+            error.append(e)
+            return
+        finally:
+            opened.set()
+
+        run_forever(self.process, 'Netlink cache')
+
+    def process(self):
+        """Read pending rtnetlink messages and apply them. Blocks when there
+        is nothing to read.
+
+        :returns: F if messages could not be read and the tables were
+                  reloaded instead.
+        """
+        log = logging.getLogger(__name__)
+        try:
+            msgs = self._ipr.get()
+        except Exception as e:
+            # most likely ENOBUFS, messages were lost - reload everything
+            log.warning('Netlink cache out of sync: %s' % str(e))
+            self._resync()
+            return False
+
+        for msg in msgs:
+            change = self._apply(msg)
+            if change is not None:
+                self._notify(*change)
+        return True
+
+    def _resync(self):
+        ipr = IPRoute()
+        try:
+            links = ipr.get_links()
+            addrs = ipr.get_addr(family=socket.AF_INET)
+            routes = ipr.get_default_routes(family=socket.AF_INET)
+        finally:
+            ipr.close()
+
+        with self._lock:
+            self._links = {}
+            self._addrs = {}
+            self._routes = {}
+            for msg in list(links) + list(addrs) + list(routes):
+                self._apply(msg)
+        self._notify('RESYNC', None, None)
+
+    def _apply(self, msg):
+        """Apply a single rtnetlink message to the cache.
+
+        :returns: Touple (event, record, old) or None if nothing changed.
+        """
+        event = msg.get('event')
+        with self._lock:
+            if event == 'RTM_NEWLINK':
+                rec = {'index': msg['index'],
+                       'ifname': msg.get_attr('IFLA_IFNAME'),
+                       'operstate': msg.get_attr('IFLA_OPERSTATE'),
+                       'carrier': msg.get_attr('IFLA_CARRIER'),
+                       'mac': msg.get_attr('IFLA_ADDRESS'),
+                       'mtu': msg.get_attr('IFLA_MTU'),
+                       'flags': msg['flags']}
+                old = self._links.get(rec['index'])
+                if old == rec:
+                    return None
+                self._links[rec['index']] = rec
+                return event, rec, old
+
+            if event == 'RTM_DELLINK':
+                old = self._links.pop(msg['index'], None)
+                self._addrs.pop(msg['index'], None)
+                for key in [k for k in self._routes if k[0] == msg['index']]:
+                    del self._routes[key]
+                return event, None, old
+
+            if event in ('RTM_NEWADDR', 'RTM_DELADDR'):
+                if msg.get('family') != socket.AF_INET:
+                    return None
+                rec = {'index': msg['index'],
+                       'address': msg.get_attr('IFA_LOCAL') or msg.get_attr('IFA_ADDRESS'),
+                       'prefixlen': msg['prefixlen'],
+                       'label': msg.get_attr('IFA_LABEL')}
+                addrs = self._addrs.setdefault(rec['index'], [])
+                if event == 'RTM_NEWADDR':
+                    if rec in addrs:
+                        return None
+                    addrs.append(rec)
+                    return event, rec, None
+                if rec not in addrs:
+                    return None
+                addrs.remove(rec)
+                return event, None, rec
+
+            if event in ('RTM_NEWROUTE', 'RTM_DELROUTE'):
+                table = msg.get_attr('RTA_TABLE') or msg.get('table')
+                if msg.get('family') != socket.AF_INET or msg.get('dst_len') != 0 or \
+                   table != RT_TABLE_MAIN:
+                    return None
+                rec = {'oif': msg.get_attr('RTA_OIF'),
+                       'gw': msg.get_attr('RTA_GATEWAY'),
+                       'priority': msg.get_attr('RTA_PRIORITY') or 0}
+                # a replaced route (eg. new gateway from DHCP) keeps the key
+                key = (rec['oif'], rec['priority'])
+                if event == 'RTM_NEWROUTE':
+                    old = self._routes.get(key)
+                    if old == rec:
+                        return None
+                    self._routes[key] = rec
+                    return event, rec, old
+                old = self._routes.pop(key, None)
+                if old is None:
+                    return None
+                return event, None, old
+
+        return None
+
+    def _notify(self, event, record, old):
+        log = logging.getLogger(__name__)
+        for callback in list(self._callbacks):
+            try:
+                callback(event, record, old)
+            except Exception as e:
+                log.error('Netlink cache callback failed: %s' % str(e))
+
+    def subscribe(self, callback):
+        """Register change notification callback(event, record, old).
+        """
+        self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        try:
+            self._callbacks.remove(callback)
+        except ValueError:
+            pass
+
+    def default_route(self):
+        """Default route with the lowest priority as {'ifname': .., 'ip': ..}.
+        """
+        ret = {'ifname': None, 'ip': None}
+        with self._lock:
+            if not self._routes:
+                return ret
+            route = min(self._routes.values(), key=lambda x: x['priority'])
+            link = self._links.get(route['oif'])
+            if link is not None:
+                ret['ifname'] = link['ifname']
+                ret['ip'] = route['gw']
+        return ret
+
+    def link(self, ifname):
+        """Link record of the interface or None.
+        """
+        with self._lock:
+            for link in self._links.values():
+                if link['ifname'] == ifname:
+                    return dict(link)
+        return None
+
+    def addresses(self, ifname):
+        """List of '<ip>/<prefixlen>' addresses of the interface.
+        """
+        with self._lock:
+            link = self.link(ifname)
+            if link is None:
+                return []
+            return ['%s/%s' % (i['address'], i['prefixlen'])
+                    for i in self._addrs.get(link['index'], [])]
+
+
+_rtnl_cache = None
+_rtnl_cache_lock = threading.Lock()
+
+
+def rtnl_cache(threaded=True):
+    """Get netlink cache of the current process. The cache is created and
+    started on the first use (also in every forked child process).
+
+    :param threaded: If F the cache is only opened and the caller is
+                     responsible for calling process() whenever fileno() of
+                     the cache is readable (eg. from a selector loop).
+    """
+    global _rtnl_cache
+
+    with _rtnl_cache_lock:
+        if _rtnl_cache is None or _rtnl_cache.pid != os.getpid():
+            cache = RtnlCache()
+            if threaded:
+                cache.start()
+            else:
+                cache.open()
+            _rtnl_cache = cache
+    return _rtnl_cache
+
+
+class LinkWatcher(object):
+    """Watch link state of a network interface using the netlink cache.
+
+    on_change(up) is called from the cache thread as soon as operstate of the
+    watched interface goes to or from 'UP'. The event is set on every such
+    transition and whenever any interface appears or disappears, so a main loop
+    can sleep in wait() and do its work only when something has changed.
+    """
+
+    def __init__(self, on_change=None):
+        self.event = threading.Event()
+        self._ifname = None
+        self._up = None
+        self._lock = threading.Lock()
+        self._on_change = on_change
+        self._cache = rtnl_cache()
+        self._cache.subscribe(self._callback)
+
+    def watch(self, ifname):
+        """Set the watched interface and check its current state.
+        """
+        with self._lock:
+            self._ifname = ifname
+        link = self._cache.link(ifname) if ifname is not None else None
+        self._update(link)
+
+    def up(self):
+        """T/F depending if the watched interface is up.
+        """
+        return self._up is True
+
+    def wait(self, timeout=None):
+        """Wait for a link change.
+
+        :returns: T/F depending if there was a change.
+        """
+        ret = self.event.wait(timeout=timeout)
+        self.event.clear()
+        return ret
+
+    def close(self):
+        self._cache.unsubscribe(self._callback)
+
+    def _callback(self, event, record, old):
+        if event == 'RESYNC':
+            self.watch(self._ifname)
+            self.event.set()
+            return
+
+        link = record if record is not None else old
+        if event not in ('RTM_NEWLINK', 'RTM_DELLINK') or link is None:
+            # not a link or removal of a link never seen
+            return
+
+        if record is None or old is None:
+            # interface appeared or disappeared
+            self.event.set()
+
+        if link['ifname'] == self._ifname:
+            self._update(record)
+
+    def _update(self, link):
+        up = link is not None and link['operstate'] == 'UP'
+        with self._lock:
+            changed = self._up is not None and up != self._up
+            changed = changed or (self._up is None and up)
+            self._up = up
+
+        if changed:
+            self.event.set()
+            if self._on_change is not None:
+                self._on_change(up)
+
+
 def get_default_route():
-    """Get list of default routes
+    """Get default route with the lowest priority.
+    """
+    try:
+        return rtnl_cache().default_route()
+    except Exception:
+        return _dump_default_route()
+
+
+def _dump_default_route():
+    """Get default route by dumping routing table. Fallback in case netlink
+    cache is not available.
     """
     ret = {'ifname': None, 'ip': None}
 
@@ -71,40 +524,85 @@ def iface_down(ifname):
     ipr.close()
 
 
-def get_address(ifname):
-    """Get first interface IP address with netmask in format
-    '192.168.1.1/24'
+def iface_snapshot(ifnames=None):
+    """Get state of interfaces from a single link dump and a single address
+    dump.
+
+    :param ifnames: List of interface names, None for all the interfaces.
+    :returns: Dict ifname -> {'address', 'addresses', 'operstate', 'mac',
+              'mtu', 'flags'}. Address is the first one in format
+              '192.168.1.1/24'. Unknown interfaces are not in the result.
     """
-    if ifname == None:
-        return
+    if ifnames is not None:
+        ifnames = [i for i in ifnames if i is not None]
+        if not ifnames:
+            return {}
 
+    ret = {}
     ipr = IPRoute()
     try:
-        for i in ipr.get_addr(label=ifname):
-            if 'prefixlen' in i and 'attrs' in i:
-                for ii in i['attrs']:
-                    if ii[0] == 'IFA_LOCAL':
-                        ipr.close()
-                        return ii[1] + '/' + str(i['prefixlen'])
-    except Exception as e:
-        pass
+        links = ipr.get_links()
+        addrs = ipr.get_addr(family=socket.AF_INET)
+    except Exception:
+        ipr.close()
+        return ret
     ipr.close()
 
-def get_operstate(ifname):
-    """Get operstate of the interface
+    index = {}
+    for link in links:
+        ifname = link.get_attr('IFLA_IFNAME')
+        if ifnames is not None and ifname not in ifnames:
+            continue
+        ret[ifname] = {'address': None,
+                       'addresses': [],
+                       'operstate': link.get_attr('IFLA_OPERSTATE'),
+                       'mac': link.get_attr('IFLA_ADDRESS'),
+                       'mtu': link.get_attr('IFLA_MTU'),
+                       'flags': link['flags']}
+        index[link['index']] = ret[ifname]
+
+    for addr in addrs:
+        rec = index.get(addr['index'])
+        local = addr.get_attr('IFA_LOCAL')
+        if rec is None or local is None:
+            continue
+        rec['addresses'].append(local + '/' + str(addr['prefixlen']))
+        if rec['address'] is None:
+            rec['address'] = rec['addresses'][0]
+
+    return ret
+
+
+def sd_notify(state):
+    """Send state notification to systemd, eg. 'READY=1'. Does nothing when
+    not run by systemd as a notify service.
+
+    :returns: T/F depending if the notification was sent.
     """
-    if ifname == None:
-        return
+    addr = os.environ.get('NOTIFY_SOCKET')
+    if not addr:
+        return False
+    if addr[0] == '@':
+        addr = '\0' + addr[1:]  # abstract namespace
 
-    ret = None
-    ipr = IPRoute()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
     try:
-        ret = ipr.get_links(ifname=ifname)[0].get_attr('IFLA_OPERSTATE')
-    except Exception as e:
-        pass
-    ipr.close()
+        sock.sendto(state.encode(), addr)
+    except OSError as e:
+        log = logging.getLogger(__name__)
+        log.error('Cannot notify systemd: %s' % str(e))
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def boottime():
+    """Seconds since boot including time spent in suspend, so startup phases
+    of every boot can be compared.
+    """
+    return round(time.clock_gettime(time.CLOCK_BOOTTIME), 3)
 
-    return ret
 
 def systemd_restart(service):
     """Enable and start systemd service.
@@ -213,25 +711,85 @@ def keys_in_dict(keys, d):
     return set(keys) <= set(d)
 
 
-def ping_test(host):
-    """Find out ping availability status.
+def ping_stats(host, ifname=None, count=5):
+    """Ping the host and get round trip times of all the echo requests.
+
+    :param ifname: Send echo requests through the given interface only.
+    :returns: List of round trip times in milliseconds, None for a lost
+              request. Empty list if fping failed without pinging, eg. the
+              interface does not exist.
     """
-    fping = FPING_PATH + ' ' + '-q -c 5 -p 10 -t 3000 ' + host
-    fping = shlex.split(fping)
+    fping = FPING_PATH + ' ' + '-q -C %d -p 10 -t 3000 ' % count
+    if ifname is not None:
+        fping += '-I %s ' % ifname
+    fping = shlex.split(fping + host)
 
     pppd = Popen(fping, stderr=PIPE, stdout=PIPE)
     ret = pppd.communicate()
 
-    # test for delimiter showing if there any packets passed
-    if b',' in ret[1]:
-        return True
-    return False
+    # per request results, eg. 'host : 1.21 1.34 - 1.18 1.25'
+    for line in ret[1].decode(errors='replace').split('\n'):
+        if ' : ' not in line:
+            continue
+        rtts = []
+        for i in line.split(' : ', 1)[1].split():
+            try:
+                rtts.append(float(i))
+            except ValueError:
+                rtts.append(None)
+        return rtts + [None] * (count - len(rtts))
+
+    log = logging.getLogger(__name__)
+    log.warning('No ping result of %s: %s' % (host, ret[1].decode(errors='replace').strip()))
+    return []
+
+
+def rx_packets(ifname):
+    """Number of packets received by the interface or None.
+    """
+    if ifname is None:
+        return None
+    try:
+        with open('/sys/class/net/%s/statistics/rx_packets' % ifname, 'r') as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
 
 
-def http_test(host):
+class BoundHTTPSConnection(httplib.HTTPSConnection):
+    """HTTPS connection bound to a network interface (SO_BINDTODEVICE).
+    Optionally connects to already resolved address of the host, server name
+    is still used for SNI and certificate check.
+    """
+
+    def __init__(self, host, ifname=None, ip=None, **kwargs):
+        super().__init__(host, **kwargs)
+        self._ifname = ifname
+        self._ip = ip
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if self._ifname is not None:
+                sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, self._ifname.encode())
+            sock.settimeout(self.timeout)
+            sock.connect((self._ip or self.host, self.port))
+        except Exception:
+            sock.close()
+            raise
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+
+
+def http_test(host, ifname=None, ip=None):
     """Check http request
+
+    :param ifname: Connect through the given interface only.
+    :param ip: Already resolved IP address of the host.
     """
-    conn = httplib.HTTPSConnection(host, timeout=3)
+    if ifname is None and ip is None:
+        conn = httplib.HTTPSConnection(host, timeout=3)
+    else:
+        conn = BoundHTTPSConnection(host, ifname=ifname, ip=ip, timeout=3)
     try:
         conn.request("HEAD", "/")
         conn.close()
@@ -241,57 +799,104 @@ def http_test(host):
     return True
 
 
-def get_usb_devices(usb, devlist):
-    """Recursively get network interfaces on USB bus. Result is stored in
-    devlist.
+def read_attr(path):
+    """Content of a sysfs attribute file, None if it does not exist.
     """
-    for k, v in usb.items():
-        for j in (getattr(v, 'interfaces', [])):
+    try:
+        with open(path, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
 
-            usbid = getattr(v, 'idVendor') + ':' + getattr(v, 'idProduct')
-            if os.path.isdir(j.fs_path + '/net'):
-                rec = {'ifname': None, 'bus': 'usb', 'port': j.fs_name,
-                       'usbid': usbid, 'iftype': 'wired'}
 
-                for ifname in glob.glob(j.fs_path + '/net/*'):
-                    rec['ifname'] = os.path.basename(ifname)
+def _usb_order(name):
+    """Sort key of USB interface names (eg. '1-1.2:1.0') ordering interfaces
+    of a device before interfaces of devices behind it.
+    """
+    port, _, iface = name.partition(':')
+    bus, _, ports = port.partition('-')
+    return (int(bus), tuple(int(i) for i in ports.split('.')), tuple(int(i) for i in iface.split('.')))
 
-                sysnetdir = '/sys/class/net/' + rec['ifname']
-                if os.path.isdir(sysnetdir + '/wireless'):
-                    rec['iftype'] = 'wifi'
 
-                if os.path.isfile(sysnetdir + '/address'):
-                    rec['mac'] = Path(sysnetdir + '/address').read_text().strip()
+def _find_tty(path):
+    """Name of tty device of USB interface, eg. 'ttyUSB0' or 'tty/ttyACM0'
+    directory entries.
+    """
+    for entry in os.scandir(path):
+        if not entry.name.startswith('tty'):
+            continue
+        if entry.name != 'tty':
+            return entry.name
+        return _find_tty(entry.path)
+    return None
 
-                devlist.append(rec)
 
-            elif j.tty is not None:
-                # detect tty capable devices
-                for i in devlist:
-                    if 'ttys' not in i:
-                        continue
+def get_usb_devices(devlist, netdevs, usb_path=USB_FS_ROOT):
+    """Get network interfaces and tty devices of USB interfaces. Result is
+    stored in devlist.
 
-                    if i['usbid'] == usbid:
-                        i['ttys'].append(j.tty)
-                        i['ttys'].sort()
-                        break
-                else:
-                    rec = {'ifname': 'ppp', 'bus': 'usb', 'port': j.fs_name,
-                           'usbid': usbid, 'iftype': 'gsm_modem', 'ttys': [j.tty]}
-                    devlist.append(rec)
+    :param netdevs: Dict ifname -> record as returned by get_netifaces(),
+                    used for type and address of USB network interfaces.
+    """
+    try:
+        names = [i.name for i in os.scandir(usb_path) if ':' in i.name]
+    except FileNotFoundError:
+        return  # no USB controller
+
+    usbids = {}
+    for name in sorted(names, key=_usb_order):
+        path = os.path.join(usb_path, name)
+        # net and tty devices are children of the interface directory
+        net = None
+        tty = None
+        for entry in os.scandir(path):
+            if entry.name == 'net':
+                net = entry.path
+                break
+            if tty is None and entry.name.startswith('tty'):
+                tty = entry.name if entry.name != 'tty' else _find_tty(entry.path)
+        if net is None and tty is None:
+            continue
 
-        get_usb_devices(v, devlist)
+        device = name.split(':')[0]
+        if device not in usbids:
+            device_path = os.path.join(usb_path, device)
+            usbids[device] = '%s:%s' % (read_attr(device_path + '/idVendor'),
+                                        read_attr(device_path + '/idProduct'))
+        usbid = usbids[device]
+
+        if net is not None:
+            rec = {'ifname': None, 'bus': 'usb', 'port': name, 'usbid': usbid, 'iftype': 'wired'}
+            for entry in os.scandir(net):
+                rec['ifname'] = entry.name
+            netdev = netdevs.get(rec['ifname'], {})
+            rec['iftype'] = netdev.get('iftype', 'wired')
+            if 'mac' in netdev:
+                rec['mac'] = netdev['mac']
+            devlist.append(rec)
+            continue
+
+        # detect tty capable devices
+        for i in devlist:
+            if 'ttys' in i and i['usbid'] == usbid:
+                i['ttys'].append(tty)
+                i['ttys'].sort()
+                break
+        else:
+            devlist.append({'ifname': 'ppp', 'bus': 'usb', 'port': name, 'usbid': usbid,
+                            'iftype': 'gsm_modem', 'ttys': [tty]})
 
 
-def get_netifaces():
+def get_netifaces(net_path=SYS_NET_PATH):
     """Returns list of interfaces from /sys/class/net
     """
     ret = []
-    for i in glob.glob('/sys/class/net/*'):
-        rec = {'ifname': os.path.basename(i), 'iftype': 'wired'}
-        if os.path.isfile(i + '/address'):
-            rec['mac'] = Path(i + '/address').read_text().strip()
-        if os.path.isdir(i + '/wireless'):
+    for entry in os.scandir(net_path):
+        rec = {'ifname': entry.name, 'iftype': 'wired'}
+        mac = read_attr(entry.path + '/address')
+        if mac is not None:
+            rec['mac'] = mac
+        if os.path.isdir(entry.path + '/wireless'):
             rec['iftype'] = 'wifi'
 
         ret.append(rec)
@@ -299,24 +904,118 @@ def get_netifaces():
     return ret
 
 
-def netifaces():
-    """Returns list of available interfaces.
+def scan_netifaces():
+    """Returns list of available interfaces read from sysfs in a single pass
+    over /sys/class/net and USB interfaces in /sys/bus/usb/devices.
     """
-    usb = USB()
+    netdevs = get_netifaces()
     devlist = []
-    get_usb_devices(usb, devlist)
+    get_usb_devices(devlist, {i['ifname']: i for i in netdevs})
 
     # merge '/sys/class/net' interfaces into usb list of interfaces
-    for dev in get_netifaces():
-        for usb_dev in devlist:
-            if dev['ifname'] == usb_dev['ifname']:
-                break
-        else:
-            devlist.append(dev)
-
+    usb_ifnames = set(i['ifname'] for i in devlist)
+    devlist.extend(i for i in netdevs if i['ifname'] not in usb_ifnames)
     return devlist
 
 
+def copy_netifaces(devices):
+    """Copy of the list of interfaces, so callers can not change the cached
+    one.
+    """
+    return [dict(i, ttys=list(i['ttys'])) if 'ttys' in i else dict(i) for i in devices]
+
+
+class DeviceIndex(object):
+    """List of interfaces (see scan_netifaces()) cached until a kernel uevent
+    tells that a USB device, network interface or tty was added, removed,
+    bound or renamed. If uevents can not be received, sysfs is scanned on
+    every lookup as before.
+
+    A scan racing with a uevent is not cached, so the next lookup scans
+    again.
+    """
+
+    def __init__(self, scan=scan_netifaces):
+        self.pid = os.getpid()
+        self._scan = scan
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._devices = None
+        self._monitor = None
+
+    def open(self):
+        """Subscribe to uevents, see uevent.uevent_monitor().
+
+        :returns: T/F depending if the index is cached.
+        """
+        log = logging.getLogger(__name__)
+        try:
+            self._monitor = uevent.uevent_monitor()
+        except OSError as e:
+            log.warning('Device index not cached, cannot receive uevents: %s' % str(e))
+            return False
+        self._monitor.subscribe(self._on_uevent)
+        return True
+
+    def _on_uevent(self, event):
+        # overflow - some events were lost
+        if event['ACTION'] == 'overflow' or uevent.is_hotplug(event):
+            self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._devices = None
+
+    def generation(self):
+        """Number of invalidations so far.
+        """
+        return self._generation
+
+    def cached(self):
+        """T/F depending if the index is invalidated by uevents.
+        """
+        return self._monitor is not None
+
+    def devices(self):
+        """Get list of interfaces, scan sysfs only if the cached one is not
+        valid.
+        """
+        with self._lock:
+            devices = self._devices
+            generation = self._generation
+        if devices is None:
+            devices = self._scan()
+            with self._lock:
+                if self._monitor is not None and generation == self._generation:
+                    self._devices = devices
+        return copy_netifaces(devices)
+
+
+_device_index = None
+_device_index_lock = threading.Lock()
+
+
+def device_index():
+    """Get device index of the current process. The index is created on the
+    first use (also in every forked child process).
+    """
+    global _device_index
+
+    with _device_index_lock:
+        if _device_index is None or _device_index.pid != os.getpid():
+            index = DeviceIndex()
+            index.open()
+            _device_index = index
+    return _device_index
+
+
+def netifaces():
+    """Returns list of available interfaces.
+    """
+    return device_index().devices()
+
+
 def get_iface(config):
     """Determine right USB modem interface
     """
@@ -338,6 +1037,68 @@ def get_iface(config):
     return None
 
 
+class NetworkdDns(object):
+    """DNS servers of links read directly from systemd-networkd state files
+    (/run/systemd/netif/links/<ifindex>). Results are cached per ifindex and
+    reloaded only after invalidate() or when the state file of the link
+    changes - networkd rewrites it on every change, eg. a new DHCP lease or
+    a link without a lease getting configured.
+    """
+
+    def __init__(self, netif_path=NETIF_PATH):
+        self._netif_path = netif_path
+        self._cache = {}  # ifindex -> (state file mtime, dns list)
+
+    def get(self, ifindex):
+        """Get list of DNS servers of the link.
+        """
+        mtime = self._state_mtime(ifindex)
+        cached = self._cache.get(ifindex)
+        if cached is not None and mtime is not None and cached[0] == mtime:
+            return cached[1]
+
+        dns_list = self._read(ifindex)
+        self._cache[ifindex] = (mtime, dns_list)
+        return dns_list
+
+    def invalidate(self, ifindex=None):
+        """Drop cached servers of the link or of all the links.
+        """
+        if ifindex is None:
+            self._cache = {}
+        else:
+            self._cache.pop(ifindex, None)
+
+    def _state_mtime(self, ifindex):
+        try:
+            return os.stat('%s/links/%s' % (self._netif_path, ifindex)).st_mtime_ns
+        except OSError:
+            return None
+
+    def _read(self, ifindex):
+        dns_list = []
+        try:
+            with open('%s/links/%s' % (self._netif_path, ifindex), 'r') as f:
+                content = f.read()
+        except OSError:
+            return dns_list
+
+        for line in content.split('\n'):
+            if not line.startswith('DNS='):
+                continue
+            for i in line[4:].split():
+                # newer networkd may append '%ifindex' or '#server_name'
+                ip = i.split('#')[0].split('%')[0]
+                try:
+                    ipaddress.ip_address(ip)
+                except ValueError:
+                    continue
+                if ip not in dns_list:
+                    dns_list.append(ip)
+
+        return dns_list
+
+
 def write_resolvconf(filepath, nameservers):
     """Write down resolv.conf file
     """
@@ -0,0 +1,137 @@
+import os
+import errno
+import socket
+import logging
+import threading
+
+import tools
+
+NETLINK_KOBJECT_UEVENT = 15
+# multicast group of uevents sent by the kernel (not udev)
+UEVENT_GROUP_KERNEL = 1
+RCVBUF_SIZE = 1024 * 1024
+# subsystems and actions changing the set of network interfaces and modems
+HOTPLUG_SUBSYSTEMS = ('usb', 'net', 'tty')
+HOTPLUG_ACTIONS = ('add', 'remove', 'bind', 'unbind', 'move')
+
+
+def parse(data):
+    """Parse kernel uevent message 'action@devpath\\0KEY=value\\0...'.
+
+    :returns: Dict of message keys (ACTION, DEVPATH, SUBSYSTEM, ...) or None
+              if the message is not a kernel uevent.
+    """
+    parts = data.split(b'\0')
+    if b'@' not in parts[0]:
+        return None  # udev message or garbage
+    ret = {}
+    for i in parts[1:]:
+        key, sep, value = i.partition(b'=')
+        if sep:
+            ret[key.decode(errors='replace')] = value.decode(errors='replace')
+    return ret if 'ACTION' in ret else None
+
+
+def is_hotplug(event):
+    """Find out if the event may change the set of network interfaces or
+    modems.
+    """
+    return event.get('SUBSYSTEM') in HOTPLUG_SUBSYSTEMS and event.get('ACTION') in HOTPLUG_ACTIONS
+
+
+class UeventMonitor(object):
+    """Monitor of kernel uevents (NETLINK_KOBJECT_UEVENT). Subscribers
+    registered by subscribe() are called as callback(event) with the parsed
+    event dict, see parse().
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self._sock = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def open(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC,
+                             NETLINK_KOBJECT_UEVENT)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+            sock.bind((0, UEVENT_GROUP_KERNEL))
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+
+    def start(self):
+        """Open the monitor and process events in a background thread.
+        """
+        self.open()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def _run(self):
+        tools.run_forever(self.process, 'Uevent monitor')
+
+    def process(self):
+        """Read a single uevent and notify subscribers. Blocks when there is
+        no event pending.
+
+        :raises OSError: When the socket cannot be read.
+        """
+        try:
+            data = self._sock.recv(65536)
+        except OSError as e:
+            if e.errno != errno.ENOBUFS:
+                raise
+            # events were lost, subscribers cannot tell what changed
+            event = {'ACTION': 'overflow', 'SUBSYSTEM': None, 'error': str(e)}
+        else:
+            event = parse(data)
+            if event is None:
+                return
+        self._notify(event)
+
+    def _notify(self, event):
+        log = logging.getLogger(__name__)
+        with self._lock:
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback(event)
+            except Exception as e:
+                log.error('Uevent callback failed: %s' % str(e))
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._callbacks.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def uevent_monitor():
+    """Get uevent monitor of the current process. The monitor is created and
+    started on the first use (also in every forked child process).
+
+    :raises OSError: When uevents cannot be received.
+    """
+    global _monitor
+
+    with _monitor_lock:
+        if _monitor is None or _monitor.pid != os.getpid():
+            monitor = UeventMonitor()
+            monitor.start()
+            _monitor = monitor
+    return _monitor
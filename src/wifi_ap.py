@@ -1,10 +1,10 @@
-import time
 import shlex
 import psutil
 import logging
 from subprocess import Popen, run, DEVNULL, PIPE
 
 import tools
+import hotplug
 from connection import Connection
 
 HOSTAPD_CONF = '/tmp/netconnect_hostapd.conf'
@@ -27,10 +27,10 @@ wpa_pairwise=TKIP CCMP
 
 class WifiAP(Connection):
 
-    def __init__(self, ev_conn):
+    def __init__(self, ev_conn, ev_status=None, status=None, runtime=None):
         """Overloaded method: constructor.
         """
-        super().__init__(ev_conn)
+        super().__init__(ev_conn, ev_status, status, runtime)
         self._status['ifname'] = None
 
     def _loop(self, config, status):
@@ -40,54 +40,62 @@ class WifiAP(Connection):
         self._status['status'] = 'NOT_CONNECTED'
         proc = None
 
-        while True:
-            if self._status['status'] != 'CONNECTED':
-                iface = tools.get_iface(config)
+        devices = hotplug.DeviceWatcher(hotplug.matcher(config))
 
-            if iface is not None:
-                self._status['ifname'] = iface.ifname
+        changed = True
+        try:
+            while True:
+                # the device may have been replaced while connected
+                if changed or self._status['status'] != 'CONNECTED':
+                    iface = tools.get_iface(config)
 
-                if tools.gen_systemd_networkd(self.__class__.__name__, config['ipv4'],
-                                              mac=iface.mac, dhcp_server=True):
-                    self._status['status'] = 'CONNECTING'
-                    tools.systemd_restart('systemd-networkd')
-                    log.info('Created systemd-networkd configuration for %s (%s)' % (iface.ifname, iface.mac))
+                if iface is not None:
+                    self._status['ifname'] = iface.ifname
 
+                    if tools.gen_systemd_networkd(self.__class__.__name__, config['ipv4'],
+                                                  mac=iface.mac, dhcp_server=True):
+                        self._status['status'] = 'CONNECTING'
+                        tools.systemd_restart('systemd-networkd')
+                        log.info('Created systemd-networkd configuration for %s (%s)' % (iface.ifname, iface.mac))
 
-                if self._hostapd_conf(iface.ifname, config['wifi_ap']):
-                    self._status['status'] = 'CONNECTING'
-                    log.info('Created hostapd configuration: %s' % (HOSTAPD_CONF))
 
-                if proc is None:
-                    self._status['status'] = 'CONNECTING'
-                    self._terminate_hostapd()
-                    hostapd_cmd = HOSTAPD_CMD % (HOSTAPD_CONF)
-                    proc = Popen(shlex.split(hostapd_cmd), stdin=DEVNULL, stderr=DEVNULL, stdout=DEVNULL)
+                    if self._hostapd_conf(iface.ifname, config['wifi_ap']):
+                        self._status['status'] = 'CONNECTING'
+                        log.info('Created hostapd configuration: %s' % (HOSTAPD_CONF))
 
-                time.sleep(1)
-                if proc.poll() is None:
-                    self._status['status'] = 'CONNECTED'
+                    if proc is None:
+                        self._status['status'] = 'CONNECTING'
+                        self._terminate_hostapd()
+                        hostapd_cmd = HOSTAPD_CMD % (HOSTAPD_CONF)
+                        proc = Popen(shlex.split(hostapd_cmd), stdin=DEVNULL, stderr=DEVNULL, stdout=DEVNULL)
 
-            else:
-                self._status['error'] = 'NO_DEVICE_DETECTED'
-                self._status['ifname'] = None
+                    self._wait(timeout=1)
+                    if proc.poll() is None:
+                        self._status['status'] = 'CONNECTED'
 
-                if tools.remove_networkd_file(self.__class__.__name__):
-                    tools.systemd_restart('systemd-networkd')
-                    log.info('Removed systemd-networkd configuration')
+                else:
+                    self._status['error'] = 'NO_DEVICE_DETECTED'
+                    self._status['ifname'] = None
 
-                if proc is not None:
-                    log.info('Terminating wpasupplicant process')
-                    proc.terminate()
-                    proc.wait()
-                    proc = None
+                    if tools.remove_networkd_file(self.__class__.__name__):
+                        tools.systemd_restart('systemd-networkd')
+                        log.info('Removed systemd-networkd configuration')
+
+                    if proc is not None:
+                        log.info('Terminating wpasupplicant process')
+                        proc.terminate()
+                        proc.wait()
+                        proc = None
 
-            if proc is not None and proc.poll() is not None:
-                # wpasupplicant interrupted
-                self._status['status'] = 'NOT_CONNECTED'
-                proc = None
+                if proc is not None and proc.poll() is not None:
+                    # wpasupplicant interrupted
+                    self._status['status'] = 'NOT_CONNECTED'
+                    proc = None
 
-            time.sleep(5)
+                changed = self._wait(devices.event, timeout=5)
+                devices.event.clear()
+        finally:
+            devices.close()
 
     def _terminate_hostapd(self):
         """Disconnect pppd session.
@@ -120,9 +128,11 @@ class WifiAP(Connection):
         """
         ret = {'status': self._status['status']}
         #ret['wireless_status'] = self._wifi_status()
-        ret['address'] = tools.get_address(self._status['ifname'])
-        ret['ifstate'] = tools.get_operstate(self._status['ifname'])
-        ret['ifname'] = self._status['ifname']
+        ifname = self._status['ifname']
+        iface = tools.iface_snapshot([ifname]).get(ifname, {})
+        ret['address'] = iface.get('address')
+        ret['ifstate'] = iface.get('operstate')
+        ret['ifname'] = ifname
         return ret
 
     def clean(self):
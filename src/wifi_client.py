@@ -1,3 +1,4 @@
+import os
 import time
 import logging
 import psutil
@@ -6,6 +7,7 @@ from subprocess import Popen, run, DEVNULL, PIPE
 from multiprocessing import Lock
 
 import tools
+import hotplug
 from connection import Connection
 
 # wpa states - DISCONNECTED, SCANNING, COMPLETED, 4WAY_HANDSHAKE, GROUP_HANDSHAKE, ASSOCIATING
@@ -14,6 +16,8 @@ WPACLI = '/sbin/wpa_cli'
 WPASUPPLICANT_CONF = '/tmp/netconnect_wpa_supplicant.conf'
 WPASUPPLICANT_CTRL = '/tmp/netconnect_wpa_supplicant.ctrl'
 WPASUPPLICANT_CMD = '/sbin/wpa_supplicant -Dwext -i %s -c %s'
+# time to wait for wpa_supplicant started by the main loop when scanning (seconds)
+WPASUPPLICANT_START_TIMEOUT = 10
 WPASUPPLICANT_CONF_CONTENT = """
 # WPA/WPA2
 network={
@@ -39,11 +43,11 @@ ctrl_interface=%s
 
 class WifiClient(Connection):
 
-    def __init__(self, ev_conn):
+    def __init__(self, ev_conn, ev_status=None, status=None, runtime=None):
         """Overloaded method: constructor.
         """
         self._wpacli_lock = Lock()
-        super().__init__(ev_conn)
+        super().__init__(ev_conn, ev_status, status, runtime)
         self._status['ifname'] = None
 
     def _loop(self, config, status):
@@ -55,77 +59,83 @@ class WifiClient(Connection):
         link_status = {}
         error_status = None
 
-        while True:
-            iface = tools.get_iface(config)
+        devices = hotplug.DeviceWatcher(hotplug.matcher(config))
 
-            if iface is not None:
-                self._status['ifname'] = iface.ifname
-
-                if tools.gen_systemd_networkd(self.__class__.__name__, config['ipv4'], mac=iface.mac,
-                                              metric=512):
-                    self._status['status'] = 'CONNECTING'
-                    tools.systemd_restart('systemd-networkd')
-                    log.info('Created systemd-networkd configuration for %s (%s)' % (iface.ifname, iface.mac))
-
-                if self._wpasupplicant_conf(config['wifi_client']):
-                    self._status['status'] = 'CONNECTING'
-                    log.info('Created wpa_supplicant configuration: %s' % (WPASUPPLICANT_CONF))
-
-                # wpasupplicant up
-                if proc is None:
-                    self._status['status'] = 'CONNECTING'
-                    log.info("Starting wpa_supplicant")
-                    self._terminate_wpasupplicant()
-                    wpasupplicant_cmd = WPASUPPLICANT_CMD % (iface.ifname, WPASUPPLICANT_CONF)
-                    proc = Popen(shlex.split(wpasupplicant_cmd), stdin=DEVNULL, stderr=DEVNULL, stdout=DEVNULL)
-
-                status = self._wifi_status()
-                if status is not None and status['status'] == 'COMPLETED':
-                    self._status['status'] = 'CONNECTED'
-
-                self._status['error'] = None
-
-            else:
-                self._status['error'] = 'NO_DEVICE_DETECTED'
-                self._status['ifname'] = None
-
-                if tools.remove_networkd_file(self.__class__.__name__):
-                    tools.systemd_restart('systemd-networkd')
-                    log.info('Removed systemd-networkd configuration')
-                    self._ev_conn.set()
-
-                if proc is not None:
-                    log.info('Terminating wpasupplicant process')
-                    proc.terminate()
-                    proc.wait()
+        try:
+            while True:
+                iface = tools.get_iface(config)
+
+                if iface is not None:
+                    self._status['ifname'] = iface.ifname
+
+                    if tools.gen_systemd_networkd(self.__class__.__name__, config['ipv4'], mac=iface.mac,
+                                                  metric=512):
+                        self._status['status'] = 'CONNECTING'
+                        tools.systemd_restart('systemd-networkd')
+                        log.info('Created systemd-networkd configuration for %s (%s)' % (iface.ifname, iface.mac))
+
+                    if self._wpasupplicant_conf(config['wifi_client']):
+                        self._status['status'] = 'CONNECTING'
+                        log.info('Created wpa_supplicant configuration: %s' % (WPASUPPLICANT_CONF))
+
+                    # wpasupplicant up
+                    if proc is None:
+                        self._status['status'] = 'CONNECTING'
+                        log.info("Starting wpa_supplicant")
+                        self._terminate_wpasupplicant()
+                        wpasupplicant_cmd = WPASUPPLICANT_CMD % (iface.ifname, WPASUPPLICANT_CONF)
+                        proc = Popen(shlex.split(wpasupplicant_cmd), stdin=DEVNULL, stderr=DEVNULL, stdout=DEVNULL)
+
+                    status = self._wifi_status()
+                    if status is not None and status['status'] == 'COMPLETED':
+                        self._status['status'] = 'CONNECTED'
+
+                    self._status['error'] = None
+
+                else:
+                    self._status['error'] = 'NO_DEVICE_DETECTED'
+                    self._status['ifname'] = None
+
+                    if tools.remove_networkd_file(self.__class__.__name__):
+                        tools.systemd_restart('systemd-networkd')
+                        log.info('Removed systemd-networkd configuration')
+                        self._ev_conn.set()
+
+                    if proc is not None:
+                        log.info('Terminating wpasupplicant process')
+                        proc.terminate()
+                        proc.wait()
+                        proc = None
+
+                if proc is not None and proc.poll() is not None:
+                    # wpasupplicant interrupted
+                    self._status['status'] = 'NOT_CONNECTED'
                     proc = None
 
-            if proc is not None and proc.poll() is not None:
-                # wpasupplicant interrupted
-                self._status['status'] = 'NOT_CONNECTED'
-                proc = None
+                # log important status changes
+                ret = self._wifi_status()
+                if ret is not None and link_status != ret:
 
-            # log important status changes
-            ret = self._wifi_status()
-            if ret is not None and link_status != ret:
+                    if ret['status'] != link_status.get('status', None):
+                        log.info('Status: %s <%s> (%s dbm)' % (ret['status'], ret['ssid'], ret['rssi']))
 
-                if ret['status'] != link_status.get('status', None):
-                    log.info('Status: %s <%s> (%s dbm)' % (ret['status'], ret['ssid'], ret['rssi']))
+                    # update online status when status change from/to COMPLETED - wifi is connected to AP
+                    if ret['status'] == 'COMPLETED' and link_status.get('status', None) != 'COMPLETED':
+                        self._ev_conn.set()
+                    if ret['status'] != 'COMPLETED' and link_status.get('status', None) == 'COMPLETED':
+                        self._ev_conn.set()
 
-                # update online status when status change from/to COMPLETED - wifi is connected to AP
-                if ret['status'] == 'COMPLETED' and link_status.get('status', None) != 'COMPLETED':
-                    self._ev_conn.set()
-                if ret['status'] != 'COMPLETED' and link_status.get('status', None) == 'COMPLETED':
-                    self._ev_conn.set()
+                    link_status = ret
 
-                link_status = ret
+                if error_status != self._status['error']:
+                    if self._status['error'] is not None:
+                        log.info('Error: %s' % (self._status['error']))
+                    error_status = self._status['error']
 
-            if error_status != self._status['error']:
-                if self._status['error'] is not None:
-                    log.info('Error: %s' % (self._status['error']))
-                error_status = self._status['error']
-
-            time.sleep(5)
+                self._wait(devices.event, timeout=5)
+                devices.event.clear()
+        finally:
+            devices.close()
 
     def _wpacli(self, command):
         """Wpa cli command. Returns stdout string or None in case of error.
@@ -168,7 +178,41 @@ class WifiClient(Connection):
             return []
         return ret
 
+    def _wait_wpasupplicant(self, timeout=WPASUPPLICANT_START_TIMEOUT):
+        """Wait for control interface of wpa_supplicant, eg. right after
+        connect() started the main loop. The control directory is watched for
+        the socket to be created, so there is no polling.
+
+        :returns: T/F depending if the control interface exists.
+        """
+        log = logging.getLogger(__name__)
+        deadline = time.monotonic() + timeout
+        try:
+            # wpa_supplicant uses the directory if it exists already
+            os.makedirs(WPASUPPLICANT_CTRL, exist_ok=True)
+            watcher = tools.FileWatcher(WPASUPPLICANT_CTRL)
+        except OSError as e:
+            log.error('Cannot watch %s: %s' % (WPASUPPLICANT_CTRL, str(e)))
+            return self._wpasupplicant_ctrl()
+
+        try:
+            while True:
+                # the main loop sets ifname before starting wpa_supplicant
+                if self._wpasupplicant_ctrl():
+                    return True
+                wait = deadline - time.monotonic()
+                if wait <= 0 or self._status['status'] == 'INACTIVE':
+                    return False
+                watcher.wait(wait)
+        finally:
+            watcher.close()
+
+    def _wpasupplicant_ctrl(self):
+        ifname = self._status['ifname']
+        return ifname is not None and os.path.exists(os.path.join(WPASUPPLICANT_CTRL, ifname))
+
     def _scan(self):
+        self._wait_wpasupplicant()
         ret = self._wpacli('scan')
         if ret is None:
             return None
@@ -230,9 +274,11 @@ class WifiClient(Connection):
 
         ret = {'status': self._status['status']}
         ret['wireless_status'] = self._wifi_status()
-        ret['address'] = tools.get_address(self._status['ifname'])
-        ret['ifstate'] = tools.get_operstate(self._status['ifname'])
-        ret['ifname'] = self._status['ifname']
+        ifname = self._status['ifname']
+        iface = tools.iface_snapshot([ifname]).get(ifname, {})
+        ret['address'] = iface.get('address')
+        ret['ifstate'] = iface.get('operstate')
+        ret['ifname'] = ifname
         return ret
 
     def clean(self):
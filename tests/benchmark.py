@@ -0,0 +1,355 @@
+import os
+import sys
+import glob
+import shutil
+import time
+import itertools
+import socket
+import threading
+import subprocess
+import unittest
+from multiprocessing import Manager
+from multiprocessing.pool import Pool
+
+import psutil
+import zmq
+
+BUILD_PATH = './build/bin'
+sys.path.insert(0, BUILD_PATH)
+
+import fs  # noqa
+import tools  # noqa
+import dnslookup  # noqa
+import interface_general  # noqa
+from status_store import StatusStore  # noqa
+from interface_netconnect import InterfaceNetconnect  # noqa
+
+TEST_HOST = 'www.google.com'
+ROUNDS = 20
+BENCH_IFACE = 'ipc:///tmp/netconnect-benchmark-%d.pipe' % os.getpid()
+# connections started for the runtime benchmark
+RUNTIME_CONFIG = {'lan': {'name': 'eth0', 'lan': {}, 'ipv4': {'dhcp': True}},
+                  'wifi_client': {'name': 'wlan0', 'wifi_client': {'ssid': 'scan'}, 'ipv4': {'dhcp': True}}}
+RUNTIME_IDLE = 30
+# time netconnect has to get ready in the runtime benchmark
+RUNTIME_START_TIMEOUT = 60
+# statement run in a fresh interpreter to count its syscalls
+SYSCALLS_SCRIPT = '''import sys
+sys.path.insert(0, %r)
+sys.path.insert(0, %r)
+import benchmark
+for i in range(%d):
+    %s
+'''
+
+
+def timeit(func, rounds=ROUNDS):
+    """Run function given number of rounds.
+
+    :returns: Average duration of a single call in milliseconds.
+    """
+    t0 = time.perf_counter()
+    for i in range(rounds):
+        func()
+    return (time.perf_counter() - t0) * 1000 / rounds
+
+
+def _pool_resolve(host):
+    try:
+        return socket.gethostbyname(host)
+    except Exception:
+        return None
+
+
+def pool_dnslookup(host, timeout=3):
+    """Former process pool based lookup kept for comparison.
+    """
+    res = None
+    pool = Pool(processes=1)
+    async_result = pool.apply_async(_pool_resolve, (host, ))
+    try:
+        res = async_result.get(timeout=timeout)
+    except Exception:
+        pool.terminate()
+    else:
+        pool.close()
+    pool.join()
+    return res
+
+
+class DnsLookup(unittest.TestCase):
+    """Process pool lookup vs. UDP stub resolver.
+    """
+    def test_lookup(self):
+        resolver = dnslookup.Resolver()
+
+        def cold():
+            resolver.flush()
+            resolver.resolve(TEST_HOST)
+
+        print('pool lookup:     %.3f ms' % timeit(lambda: pool_dnslookup(TEST_HOST)))
+        print('resolver (cold): %.3f ms' % timeit(cold))
+        print('resolver (warm): %.3f ms' % timeit(lambda: resolver.resolve(TEST_HOST)))
+
+
+def status_payload():
+    """Status as returned by Netconnect.status() with all connections up.
+    """
+    stats = {'samples': 100, 'min': 11.2, 'avg': 14.87, 'p95': 31.4, 'loss': 1.0}
+    conns = {}
+    for name, ifname in [('lte', 'ppp0'), ('wifi_client', 'wlan1'), ('wifi_ap', 'wlan0'), ('lan', 'eth0')]:
+        conns[name] = {'status': 'CONNECTED', 'error': None, 'ifname': ifname,
+                       'config': {'name': ifname, 'metric': 300, 'ipv4': {'dhcp': True}},
+                       'online': True, 'stats': stats}
+    conns['lte']['dns'] = ['10.0.0.1', '10.0.0.2']
+    conns['ncstatus'] = {'online': True, 'last_online_check': 1600000000, 'test_host': TEST_HOST,
+                         'test_hosts': [TEST_HOST, 'www.seznam.cz'], 'probes': ['ping', 'http'],
+                         'quorum': 1, 'dns': ['192.168.1.1'], 'link_to_online': 1.532,
+                         'uplinks': {i: {'ifname': 'eth0', 'online': True, 'last_check': 1600000000,
+                                         'stats': stats} for i in ('lte', 'wifi_client', 'lan')}}
+    conns['gw'] = {'ifname': 'eth0', 'ip': '192.168.1.1'}
+    return conns
+
+
+def wifi_scan_payload(count=40):
+    """Result of a wifi scan in a busy area.
+    """
+    return [{'ssid': 'network-%02d' % i, 'channel': str(2412 + 5 * (i % 13)), 'enc': bool(i % 4),
+             'signal': -40 - i} for i in range(count)]
+
+
+def interfaces_payload():
+    """List of interfaces of a box with LTE modem and two wifi dongles.
+    """
+    ret = [{'ifname': 'ppp', 'bus': 'usb', 'port': '1-1.2:1.0', 'usbid': '12d1:1506',
+            'iftype': 'gsm_modem', 'ttys': ['ttyUSB0', 'ttyUSB1', 'ttyUSB2']}]
+    for i, port in enumerate(['1-1.3:1.0', '1-1.4:1.0']):
+        ret.append({'ifname': 'wlan%d' % i, 'bus': 'usb', 'port': port, 'usbid': '148f:7601',
+                    'iftype': 'wifi', 'mac': '00:11:22:33:44:%02x' % i})
+    for ifname in ['lo', 'eth0', 'eth1', 'docker0', 'veth1a2b3c']:
+        ret.append({'ifname': ifname, 'iftype': 'wired', 'mac': '00:aa:bb:cc:dd:ee'})
+    return ret
+
+
+class Encoding(unittest.TestCase):
+    """JSON vs. msgpack encoding of typical responses.
+    """
+    def test_encoding(self):
+        for name, payload in [('status', status_payload()), ('wifi_scan', wifi_scan_payload()),
+                              ('interfaces', interfaces_payload())]:
+            msg = {'mod_name': 'netconnect-interface', 'status': 'success', 'message': payload}
+            for encoding in interface_general.encodings():
+                data = interface_general.encode(msg, encoding)
+                enc = timeit(lambda: interface_general.encode(msg, encoding), 1000)
+                dec = timeit(lambda: interface_general.decode(data), 1000)
+                print('%-10s %-7s %5d B  encode %.4f ms  decode %.4f ms' % (name, encoding, len(data), enc, dec))
+
+
+class Status(unittest.TestCase):
+    """Manager dict proxies vs. shared memory status store.
+    """
+    def test_status(self):
+        status = status_payload()['lan']
+        counter = itertools.count()
+        mgr = Manager()
+        proxy = mgr.dict(status)
+        rss = psutil.Process(mgr._process.pid).memory_info().rss
+        print('manager: server process RSS %.1f MB' % (rss / 1024.0 / 1024.0))
+        print('manager: read key %.4f ms, copy %.4f ms, write %.4f ms' % (
+              timeit(lambda: proxy['status'], 1000), timeit(lambda: proxy.copy(), 1000),
+              timeit(lambda: proxy.__setitem__('counter', next(counter)), 1000)))
+        mgr.shutdown()
+
+        store = StatusStore(['lte', 'wifi_client', 'wifi_ap', 'lan', 'ncstatus'])
+        record = store.record('lan')
+        record.update(status)
+        print('store: shared memory %.1f kB for 5 records' % (store.size() / 1024.0))
+        print('store:   read key %.4f ms, copy %.4f ms, write %.4f ms' % (
+              timeit(lambda: record['status'], 1000), timeit(lambda: record.copy(), 1000),
+              timeit(lambda: record.__setitem__('counter', next(counter)), 1000)))
+
+
+class DeviceIndex(unittest.TestCase):
+    """Interface lookup scanning sysfs vs. uevent invalidated device index.
+    """
+    def test_lookup(self):
+        index = tools.device_index()
+        index.devices()
+        print('sysfs scan: %.4f ms' % timeit(tools.scan_netifaces, 200))
+        print('cached:     %.4f ms' % timeit(index.devices, 1000))
+
+
+def tree_get_usb_devices(usb, devlist):
+    """Former recursive walk over fs.USB tree kept for comparison.
+    """
+    for k, v in usb.items():
+        for j in (getattr(v, 'interfaces', [])):
+            usbid = getattr(v, 'idVendor') + ':' + getattr(v, 'idProduct')
+            if os.path.isdir(j.fs_path + '/net'):
+                rec = {'ifname': None, 'bus': 'usb', 'port': j.fs_name,
+                       'usbid': usbid, 'iftype': 'wired'}
+                for ifname in glob.glob(j.fs_path + '/net/*'):
+                    rec['ifname'] = os.path.basename(ifname)
+                sysnetdir = '/sys/class/net/' + rec['ifname']
+                if os.path.isdir(sysnetdir + '/wireless'):
+                    rec['iftype'] = 'wifi'
+                if os.path.isfile(sysnetdir + '/address'):
+                    with open(sysnetdir + '/address') as file:
+                        rec['mac'] = file.read().strip()
+                devlist.append(rec)
+            elif j.tty is not None:
+                for i in devlist:
+                    if 'ttys' in i and i['usbid'] == usbid:
+                        i['ttys'].append(j.tty)
+                        i['ttys'].sort()
+                        break
+                else:
+                    devlist.append({'ifname': 'ppp', 'bus': 'usb', 'port': j.fs_name,
+                                    'usbid': usbid, 'iftype': 'gsm_modem', 'ttys': [j.tty]})
+        tree_get_usb_devices(v, devlist)
+
+
+def tree_netifaces():
+    """Former sysfs scan kept for comparison.
+    """
+    devlist = []
+    if os.path.isdir(fs.USB_FS_ROOT):
+        tree_get_usb_devices(fs.USB(), devlist)
+    for i in glob.glob('/sys/class/net/*'):
+        rec = {'ifname': os.path.basename(i), 'iftype': 'wired'}
+        if os.path.isfile(i + '/address'):
+            with open(i + '/address') as file:
+                rec['mac'] = file.read().strip()
+        if os.path.isdir(i + '/wireless'):
+            rec['iftype'] = 'wifi'
+        if all(rec['ifname'] != j['ifname'] for j in devlist):
+            devlist.append(rec)
+    return devlist
+
+
+def count_syscalls(stmt, rounds=ROUNDS):
+    """Count syscalls of the statement run in a fresh interpreter by strace.
+
+    :returns: Average number of syscalls of a single run.
+    """
+    def total(stmt, rounds):
+        out = '/tmp/netconnect-benchmark-strace-%d' % os.getpid()
+        script = SYSCALLS_SCRIPT % (BUILD_PATH, os.path.dirname(os.path.abspath(__file__)), rounds, stmt)
+        subprocess.check_call(['strace', '-f', '-c', '-o', out, sys.executable, '-c', script],
+                              stdout=subprocess.DEVNULL)
+        with open(out) as file:
+            lines = file.read().strip().splitlines()
+        os.remove(out)
+        return int(lines[-1].split()[3])
+
+    return (total(stmt, rounds) - total('pass', rounds)) / rounds
+
+
+class Sysfs(unittest.TestCase):
+    """Recursive fs.USB tree walk vs. flat scandir based scan of sysfs.
+    """
+    def test_scan(self):
+        self.assertEqual(tree_netifaces(), tools.scan_netifaces())
+        print('tree walk: %.4f ms' % timeit(tree_netifaces, 200))
+        print('flat scan: %.4f ms' % timeit(tools.scan_netifaces, 200))
+
+    @unittest.skipIf(shutil.which('strace') is None, 'strace not installed')
+    def test_syscalls(self):
+        print('tree walk: %.1f syscalls' % count_syscalls('benchmark.tree_netifaces()'))
+        print('flat scan: %.1f syscalls' % count_syscalls('benchmark.tools.scan_netifaces()'))
+
+
+class EchoInterface(InterfaceNetconnect):
+    """Minimal server side of the interface.
+    """
+    def echo(self, param1, param2):
+        return [param1, param2]
+
+
+def start_echo_server(iface=BENCH_IFACE):
+    """Run echo interface server in a background thread.
+    """
+    threading.Thread(target=EchoInterface(iface).loop, daemon=True).start()
+    i_n = InterfaceNetconnect(iface)
+    i_n.echo('a', 'b')  # wait for the server
+    return i_n
+
+
+def fresh_socket_echo(iface, timeout=5000):
+    """Former client side - new context, socket and connection per request.
+    """
+    context = zmq.Context()
+    req_socket = context.socket(zmq.REQ)
+    req_socket.setsockopt(zmq.RCVTIMEO, timeout)
+    req_socket.setsockopt(zmq.SNDTIMEO, timeout)
+    req_socket.setsockopt(zmq.REQ_RELAXED, 1)
+    req_socket.setsockopt(zmq.REQ_CORRELATE, 1)
+    req_socket.setsockopt(zmq.LINGER, 0)
+    req_socket.connect(iface)
+    try:
+        req_socket.send_json({'src_mid': 'benchmark', 'func': 'echo', 'params': ['a', 'b']})
+        return req_socket.recv_json()
+    finally:
+        req_socket.close()
+        context.destroy()
+
+
+class Rpc(unittest.TestCase):
+    """RPC round trip latency.
+    """
+    def test_round_trip(self):
+        i_n = start_echo_server()
+        print('fresh socket per call: %.3f ms' % timeit(lambda: fresh_socket_echo(BENCH_IFACE), 200))
+        print('pooled socket:         %.3f ms' % timeit(lambda: i_n.echo('a', 'b'), 200))
+
+
+def process_tree(pid):
+    proc = psutil.Process(pid)
+    return [proc] + proc.children(recursive=True)
+
+
+def measure_runtime(runtime):
+    """Start netconnect with given runtime and measure total RSS and CPU
+    time of all its processes while idle.
+    """
+    env = dict(os.environ)
+    if runtime is not None:
+        env['NETCONNECT_RUNTIME'] = runtime
+    proc = subprocess.Popen([sys.executable, BUILD_PATH + '/netconnect.py'], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        i_n = InterfaceNetconnect()
+        deadline = time.monotonic() + RUNTIME_START_TIMEOUT
+        while not i_n.wait_for_ready(timeout=1):
+            if proc.poll() is not None:
+                raise AssertionError('netconnect exited with code %d' % proc.returncode)
+            if time.monotonic() > deadline:
+                raise AssertionError('netconnect not ready in %d s' % RUNTIME_START_TIMEOUT)
+        i_n.connect(RUNTIME_CONFIG)
+        time.sleep(5)
+
+        procs = process_tree(proc.pid)
+        cpu0 = sum(sum(i.cpu_times()[:2]) for i in procs)
+        time.sleep(RUNTIME_IDLE)
+        procs = process_tree(proc.pid)
+        cpu = sum(sum(i.cpu_times()[:2]) for i in procs) - cpu0
+        rss = sum(i.memory_info().rss for i in procs)
+        return len(procs), rss, cpu
+    finally:
+        for i in process_tree(proc.pid):
+            i.kill()
+        proc.wait()
+
+
+class Runtime(unittest.TestCase):
+    """Process per connection vs. single process asyncio runtime.
+    """
+    def test_runtime(self):
+        for runtime in [None, 'asyncio']:
+            count, rss, cpu = measure_runtime(runtime)
+            print('%-8s %2d processes, RSS %.1f MB, CPU %.2f s in %d s' % (
+                  runtime or 'process', count, rss / 1024.0 / 1024.0, cpu, RUNTIME_IDLE))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,11 @@
 import sys
+import asyncio
 import unittest
 
 BUILD_PATH = './build/bin'
 sys.path.insert(0, BUILD_PATH)
 
-from interface_netconnect import InterfaceNetconnect  # noqa
+from interface_netconnect import InterfaceNetconnect, AsyncInterfaceNetconnect  # noqa
 
 ZMQ_IFACE = 'ipc:///tmp/netconnect-interface.pipe'
 
@@ -17,11 +18,37 @@ class Base(unittest.TestCase):
         ret = i_a.echo('a', 'b')
         print(ret)
 
+    def test_ready(self):
+        i_a = InterfaceNetconnect(ZMQ_IFACE)
+        self.assertTrue(i_a.wait_for_ready(timeout=10))
+        print(i_a.status()['phases'])
+
     def test_status(self):
         i_a = InterfaceNetconnect(ZMQ_IFACE)
         ret = i_a.status()
         print(ret)
 
+    def test_status_since(self):
+        i_a = InterfaceNetconnect(ZMQ_IFACE)
+        version = i_a.status()['version']
+        self.assertGreaterEqual(i_a.status_version(), version)
+        print(i_a.status_since(version))
+
+    def test_batch(self):
+        i_a = InterfaceNetconnect(ZMQ_IFACE)
+        ret = i_a.batch([{'func': 'echo', 'params': ['a', 'b']},
+                         {'func': 'connection_info', 'params': ['lan']},
+                         {'func': 'status', 'params': []}])
+        for i in ret:
+            print(i)
+
+    def test_subscribe(self):
+        i_a = InterfaceNetconnect(ZMQ_IFACE)
+        sub = i_a.subscribe()
+        print(sub.last())
+        print(sub.recv(timeout=5000))
+        sub.close()
+
     def test_interfaces(self):
         i_a = InterfaceNetconnect(ZMQ_IFACE)
         ret = i_a.interfaces()
@@ -36,6 +63,31 @@ class Base(unittest.TestCase):
         i_a = InterfaceNetconnect(ZMQ_IFACE)
         i_a.config({'test_host': 'www.seznam.cz'})
 
+    def test_config_targets(self):
+        i_a = InterfaceNetconnect(ZMQ_IFACE)
+        i_a.config({'test_hosts': ['www.seznam.cz', 'www.google.com', '1.1.1.1'],
+                    'probes': ['ping', 'http'],
+                    'quorum': 1})
+
+
+class Async(unittest.TestCase):
+    """Asyncio client tests.
+    """
+    def test_parity(self):
+        for name in dir(InterfaceNetconnect):
+            if not name.startswith('_') and name != 'loop':
+                self.assertTrue(hasattr(AsyncInterfaceNetconnect, name), name)
+
+    def test_concurrent(self):
+        async def run():
+            i_a = AsyncInterfaceNetconnect(ZMQ_IFACE)
+            ret = await asyncio.gather(i_a.echo('a', 'b'), i_a.status(), i_a.interfaces())
+            i_a.close()
+            return ret
+
+        for i in asyncio.run(run()):
+            print(i)
+
 
 class LTE(unittest.TestCase):
     """LTE Tests.
@@ -0,0 +1,109 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+BUILD_PATH = './build/bin'
+sys.path.insert(0, BUILD_PATH)
+
+import hotplug  # noqa
+
+# USB device and its interface in the fake sysfs tree
+USB_DEVICE = '/devices/platform/usb1/1-1/1-1.2'
+USB_PORT = '1-1.2:1.0'
+USB_ID = '1234:abcd'
+
+
+class Hotplug(unittest.TestCase):
+    """Device events of kernel uevents, read from a fake sysfs tree
+    """
+    def setUp(self):
+        self.sys_path = tempfile.mkdtemp()
+        self.mkfile(USB_DEVICE + '/idVendor', '1234')
+        self.mkfile(USB_DEVICE + '/idProduct', 'abcd')
+        self.hotplug = hotplug.Hotplug(self.sys_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.sys_path)
+
+    def mkfile(self, path, content):
+        path = self.sys_path + path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content + '\n')
+
+    def add_net(self, ifname, mac):
+        devpath = '%s/%s/net/%s' % (USB_DEVICE, USB_PORT, ifname)
+        self.mkfile(devpath + '/address', mac)
+        return devpath
+
+    def events(self, **uevent):
+        return list(self.hotplug._events(uevent))
+
+    def test_add(self):
+        devpath = self.add_net('eth1', '00:11:22:33:44:55')
+        ret = self.events(ACTION='add', SUBSYSTEM='net', DEVPATH=devpath, INTERFACE='eth1')
+        self.assertEqual(len(ret), 1)
+        self.assertEqual(ret[0].kind, hotplug.NET_ADDED)
+        self.assertEqual(ret[0].ifname, 'eth1')
+        self.assertEqual(ret[0].mac, '00:11:22:33:44:55')
+        self.assertEqual(ret[0].port, USB_PORT)
+        self.assertEqual(ret[0].usbid, USB_ID)
+
+    def test_remove(self):
+        devpath = self.add_net('eth1', '00:11:22:33:44:55')
+        self.events(ACTION='add', SUBSYSTEM='net', DEVPATH=devpath, INTERFACE='eth1')
+        # keys are remembered, the device is gone from sysfs already
+        shutil.rmtree(self.sys_path + USB_DEVICE)
+        ret = self.events(ACTION='remove', SUBSYSTEM='net', DEVPATH=devpath, INTERFACE='eth1')
+        self.assertEqual(len(ret), 1)
+        self.assertEqual(ret[0].kind, hotplug.NET_REMOVED)
+        self.assertEqual(ret[0].ifname, 'eth1')
+        self.assertEqual(ret[0].mac, '00:11:22:33:44:55')
+        self.assertEqual(ret[0].port, USB_PORT)
+        self.assertEqual(ret[0].usbid, USB_ID)
+
+    def test_move(self):
+        old = self.add_net('eth1', '00:11:22:33:44:55')
+        self.events(ACTION='add', SUBSYSTEM='net', DEVPATH=old, INTERFACE='eth1')
+        shutil.rmtree(self.sys_path + old)
+        devpath = self.add_net('wwan0', '00:11:22:33:44:55')
+        ret = self.events(ACTION='move', SUBSYSTEM='net', DEVPATH=devpath, DEVPATH_OLD=old, INTERFACE='wwan0')
+        self.assertEqual([(i.kind, i.ifname) for i in ret],
+                         [(hotplug.NET_REMOVED, 'eth1'), (hotplug.NET_ADDED, 'wwan0')])
+        self.assertEqual(ret[0].mac, '00:11:22:33:44:55')
+        self.assertEqual(ret[1].port, USB_PORT)
+
+    def test_remove_unknown(self):
+        devpath = '%s/%s/net/eth2' % (USB_DEVICE, USB_PORT)
+        ret = self.events(ACTION='remove', SUBSYSTEM='net', DEVPATH=devpath, INTERFACE='eth2')
+        self.assertEqual(len(ret), 1)
+        self.assertEqual(ret[0].kind, hotplug.NET_REMOVED)
+        self.assertEqual(ret[0].ifname, 'eth2')
+        self.assertEqual(ret[0].port, USB_PORT)
+        self.assertIsNone(ret[0].mac)
+
+    def test_tty(self):
+        devpath = '%s/%s/ttyUSB0/tty/ttyUSB0' % (USB_DEVICE, USB_PORT)
+        ret = self.events(ACTION='add', SUBSYSTEM='tty', DEVPATH=devpath, DEVNAME='/dev/ttyUSB0')
+        self.assertEqual([(i.kind, i.tty, i.port, i.usbid) for i in ret],
+                         [(hotplug.TTY_ADDED, 'ttyUSB0', USB_PORT, USB_ID)])
+        # ttys not on USB are not modems
+        ret = self.events(ACTION='add', SUBSYSTEM='tty', DEVPATH='/devices/virtual/tty/tty1', DEVNAME='tty1')
+        self.assertEqual(ret, [])
+
+    def test_matcher(self):
+        event = hotplug.DeviceEvent(hotplug.NET_ADDED, 'eth1', '00:11:22:33:44:55', USB_PORT, USB_ID)
+        self.assertTrue(hotplug.matcher({'name': 'eth1'})(event))
+        self.assertTrue(hotplug.matcher({'usb_port': USB_PORT})(event))
+        self.assertTrue(hotplug.matcher({'mac': '00:11:22:33:44:55'})(event))
+        self.assertFalse(hotplug.matcher({'name': 'eth0'})(event))
+        # mac takes precedence over the name
+        self.assertFalse(hotplug.matcher({'mac': '00:11:22:33:44:66', 'name': 'eth1'})(event))
+        tty = hotplug.DeviceEvent(hotplug.TTY_ADDED, port=USB_PORT, tty='ttyUSB0')
+        self.assertFalse(hotplug.matcher({'usb_port': USB_PORT})(tty))
+
+
+if __name__ == '__main__':
+    unittest.main()